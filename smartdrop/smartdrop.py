@@ -1,9 +1,4 @@
 '''
-TODO: 
-Fix detectServers()
-List of server and task keys referenced by multiple dictionaries. Ensures each dict.
-is using the same key.
-
 -------------------------------------
 Author: Connor Rawls
 Email: connorrawls1996@gmail.com
@@ -15,14 +10,16 @@ task types based upon SLO requirements (1 second). Communicate this information
 the load balancer.
 
 Three processes run concurrently:
-  -taskEvent
+  -taskEvent (one per --workers shard of task IDs)
   -cpuUsage
   -comms
-Six objects are referenced globally:
+With --partition I/N an instance tracks only the servers whose HAProxy id is
+I mod N and sends its part of the whitelist to a --mode merge instance, which
+serves the load balancers.
+Objects referenced globally (indexed by Registry task and server ids):
   -profile_matrix
-  -workload
-  -cpu_usage
-  -predicted_time
+  -state (workload, cpu_usage, predicted_time)
+  -whitelist
 '''
 
 import os
@@ -30,26 +27,117 @@ import sys
 import csv
 import subprocess
 import re
+import math
 import socket
+import select
+import ctypes
+import struct
+import selectors
 import json
 import time
+import zlib
 import sys
 import itertools
 import random
+import threading
+import signal
+import bisect
+import asyncio
+import argparse
 from datetime import datetime
-from multiprocessing import Process, Manager, Lock
-import libvirt
-import pandas as pd
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, shared_memory
 import numpy as np
 from pickle import load
 from sklearn.ensemble import GradientBoostingRegressor
 
 # Used for remote messaging locks
 MSGLEN = 1
-SRVCOUNT = 7
+HOST = 'smartdrop'
+PORT = 8080
+# HAProxy runtime API (through the stats-front TCP frontend) and its backend
+STATS_SOCKET = 'TCP:haproxy:90'
+BACKEND = 'web_servers'
+# Server slots preallocated in shared state, HAProxy server ids are the keys.
+# The whitelist and log formats carry one character per server id (HAProxy's
+# onWhitelist() matches the id's last digit), so only ids 1-9 are served.
+MAX_SERVERS = 9
+# Servers assumed while the runtime API is unreachable at startup
+# (ids 1-7 on domains WP-Host, WP-Host-02, ...), discovery replaces them
+DEFAULT_SERVERS = 7
+# Bytes kept per HAProxy server name (libvirt domain name)
+NAME_LEN = 64
+# Seconds between server discovery polls and the limit on each poll
+DISCOVERY_INTERVAL = 5.
+DISCOVERY_TIMEOUT = 2.
 # Service Level Objective = 1 second = 1,000,000 (1e6) microseconds
 SLO = 1.e6
+# Fold the input scaler into the feature block at load time and apply the
+# output scaler as an affine map
+FUSE_SCALERS = True
+# Minimum input change before a server's predictions are recomputed
+WL_EPSILON = 1.e3   # Microseconds of queued work
+CPU_EPSILON = 0.5   # Percent utilization
+# Prediction cache capacity in server states (each holds every task type's
+# prediction) and bucket widths (<= 0 disables quantization)
+CACHE_SIZE = 16 * MAX_SERVERS
+WL_BUCKET = 1.e4    # Microseconds of queued work
+CPU_BUCKET = 1.     # Percent utilization
+# Seconds between background whitelist refreshes
+REFRESH_INTERVAL = 1.
+# Where partitions send their whitelists to the merge instance
+MERGE_HOST = 'localhost'
+MERGE_PORT = 8081
+# Seconds a handshake waits for a fresh whitelist before serving a stale one
+COMPUTE_DEADLINE = 0.05
+# Initial rows of the in-flight request table (doubles when full)
+INFLIGHT_CAPACITY = 4096
+# Seconds before an in-flight request without a completion line is reaped
+INFLIGHT_TTL = 30.
+# Expiry resolution of the in-flight timer wheel in seconds
+WHEEL_TICK = 1.
+# Seconds between log polls at EOF where inotify is unavailable
+TAIL_INTERVAL = 0.01
+# Longest wait for an inotify event before the log is read anyway
+TAIL_POLL = 0.25
+# Bytes read from the log per batch
+TAIL_CHUNK = 1 << 16
+# Seconds between saves of a worker's log offset
+CHECKPOINT_INTERVAL = 1.
+# Bytes of log before the resume point replayed to rebuild in-flight requests
+REPLAY_BYTES = 1 << 22
+# Largest datagram read from the event feed socket
+FEED_DATAGRAM = 1 << 16
+# Kernel receive buffer of the event feed, absorbs bursts between batches
+FEED_BUFFER = 1 << 22
+# Syslog header (RFC 5424 or RFC 3164) in front of a fed event, events
+# forwarded without one are parsed as they are
+SYSLOG_HEADER = re.compile(r'<\d{1,3}>(?:1 (?:\S+ ){6}|.*?: )\ufeff?')
+# inotify events that mean the access log may have new data
+IN_MODIFY = 0x002
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
 CURR_PATH = os.getcwd()
+# Access log tailed for task events and the per-request record it produces
+TASK_EVENT_PATH = '/var/log/apache_access.log'
+RECORD_PATH = CURR_PATH + '/../logs/smartdrop.log'
+# Access log offset of each worker, suffixed with its partition and shard
+CHECKPOINT_PATH = CURR_PATH + '/../logs/smartdrop.offset'
+# Log line status characters
+STATUS_KEY = {'+' : 'new', '>' : 'complete', '-' : 'sent'}
+# Log line field separators, the task ID following the status character and
+# the requested file's content
+DELIMITERS = re.compile(r'[,\s|]')
+TASK_ID = re.compile(r'[^,\s|]*')
+CONTENT = re.compile(r'file:([^,\s|]*)')
+# Server id ending the server field, read whole so id 11 never passes for 1
+SERVER_ID = re.compile(r'\d*$')
+# Per-stage latency histograms (dumped on SIGUSR1), task event workers
+# write theirs to latency.<partition>.<shard>.json beside it
+STATS_PATH = CURR_PATH + '/../logs/latency.json'
+STATS_INTERVAL = 10.
 
 # TaskType is an HTTP request possessing known characteristics
 class TaskType:
@@ -64,538 +152,1922 @@ class TaskType:
         self.avg_time = avg_time
         self.time_stdev = time_stdev
 
-# Instance is a member of a given TaskType
-class Instance(TaskType):
-    def __init__(self, task_type, server, workload, cpu_usage, predicted_time):
-        super().__init__(
-            task_type.method,
-            task_type.url,
-            task_type.query,
-            task_type.content,
-            task_type.avg_size,
-            task_type.size_stdev,
-            task_type.avg_time,
-            task_type.time_stdev
-        )
-        self.server = server
-        self.workload = workload
-        self.cpu_usage = cpu_usage
-        self.predicted_time = predicted_time
-
-    def toList(self):
+# InFlightTable holds admitted requests as fixed-width columns, not objects
+class InFlightTable:
+    __slots__ = ('capacity', 'task', 'srv', 'workload', 'cpu_usage', \
+        'predicted_time', 'admitted', 'slots', 'free', 'ttl', 'tick', 'wheel', \
+        'last_tick')
+
+    def __init__(self, capacity = INFLIGHT_CAPACITY, ttl = INFLIGHT_TTL, \
+        tick = WHEEL_TICK):
+        self.capacity = 0
+        self.task = np.empty(0, dtype = np.int32)
+        self.srv = np.empty(0, dtype = np.int32)
+        self.workload = np.empty(0)
+        self.cpu_usage = np.empty(0)
+        self.predicted_time = np.empty(0)
+        # Monotonic admission time of each row
+        self.admitted = np.empty(0)
+        # Log task id -> row, and rows available for reuse
+        self.slots = {}
+        self.free = []
+        self.grow(capacity)
+        # Timer wheel: one bucket of (task id, row) per tick of the TTL
+        self.ttl = ttl
+        self.tick = tick
+        self.wheel = [[] for _ in range(int(np.ceil(ttl / tick)) + 1)]
+        self.last_tick = None
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, task_id):
+        return task_id in self.slots
+
+    # Double the columns when full, existing rows keep their index
+    def grow(self, capacity):
+        for name in ('task', 'srv', 'workload', 'cpu_usage', 'predicted_time', \
+            'admitted'):
+            old = getattr(self, name)
+            column = np.zeros(capacity, dtype = old.dtype)
+            column[:self.capacity] = old
+            setattr(self, name, column)
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def add(self, task_id, task, srv, workload, cpu_usage, predicted_time, \
+        now = None):
+        if now is None: now = time.monotonic()
+        if not self.free: self.grow(self.capacity * 2)
+        row = self.free.pop()
+        self.slots[task_id] = row
+        self.task[row] = task
+        self.srv[row] = srv
+        self.workload[row] = workload
+        self.cpu_usage[row] = cpu_usage
+        self.predicted_time[row] = predicted_time
+        self.admitted[row] = now
+        # Rounded up, the row is past its TTL once its bucket comes round
+        expiry = math.ceil((now + self.ttl) / self.tick)
+        self.wheel[expiry % len(self.wheel)].append((task_id, row))
+
+    # Release a request's row, returns its row (KeyError if unknown).
+    # Its wheel entry is left behind and dropped when that bucket comes round.
+    def pop(self, task_id):
+        row = self.slots.pop(task_id)
+        self.free.append(row)
+        return row
+
+    # Release every row on a server slot, returns them
+    def dropServer(self, srv):
+        task_ids = [task_id for (task_id, row) in self.slots.items() \
+            if self.srv[row] == srv]
+        return [self.pop(task_id) for task_id in task_ids]
+
+    # Release rows admitted more than ttl ago, returns them (unwritten until reuse)
+    def expire(self, now = None):
+        if now is None: now = time.monotonic()
+        current = int(now / self.tick)
+        if self.last_tick is None: self.last_tick = current - len(self.wheel)
+        if current <= self.last_tick: return []
+
+        expired = []
+        deadline = now - self.ttl
+        start = max(self.last_tick + 1, current - len(self.wheel) + 1)
+        for tick in range(start, current + 1):
+            bucket = self.wheel[tick % len(self.wheel)]
+            pending = []
+            for (task_id, row) in bucket:
+                # Completed or reused rows no longer match their entry
+                if self.slots.get(task_id) != row: continue
+                if self.admitted[row] <= deadline:
+                    expired.append(self.pop(task_id))
+                else: pending.append((task_id, row))
+            self.wheel[tick % len(self.wheel)] = pending
+        self.last_tick = current
+        return expired
+
+    # Record file line for a row, task attributes come from the registry
+    def toList(self, row, registry):
+        task_type = registry.task_types[self.task[row]]
         list_str = (
-            f'{self.method},{self.url},{self.query},{self.content},'
-            f'{self.avg_size},{self.size_stdev},{self.avg_time},'
-            f'{self.time_stdev},{self.server},{self.workload},'
-            f'{self.predicted_time},{self.cpu_usage}'
+            f'{task_type.method},{task_type.url},{task_type.query},'
+            f'{task_type.content},{task_type.avg_size},{task_type.size_stdev},'
+            f'{task_type.avg_time},{task_type.time_stdev},'
+            f'{registry.servers[self.srv[row]]},{self.workload[row]},'
+            f'{self.predicted_time[row]},{self.cpu_usage[row]}'
         )
         return list_str
 
+    # Approximate bytes held by the columns, id map, free list and wheel
+    def footprint(self):
+        columns = self.task.nbytes + self.srv.nbytes + self.workload.nbytes \
+            + self.cpu_usage.nbytes + self.predicted_time.nbytes \
+            + self.admitted.nbytes
+        index = sys.getsizeof(self.slots) \
+            + sum(sys.getsizeof(task_id) for task_id in self.slots)
+        wheel = sum(sys.getsizeof(bucket) for bucket in self.wheel)
+        return columns + index + sys.getsizeof(self.free) + wheel
+
+# Registry interns task keys and server names as dense integer ids.
+# Server ids are slots of a fixed capacity, free slots hold None.
+class Registry:
+    def __init__(self, profile_matrix, servers, names = None, capacity = None, \
+        partition = (0, 1)):
+        self.tasks = list(profile_matrix.keys())
+        self.task_ids = {task: i for (i, task) in enumerate(self.tasks)}
+        # Per-id attributes used on hot paths
+        self.task_types = [profile_matrix[task] for task in self.tasks]
+        self.avg_time = np.array([float(task_type.avg_time) \
+            for task_type in self.task_types])
+        # Known field values, so log lines are rejected without scanning tasks
+        self.methods = {task_type.method for task_type in self.task_types}
+        self.urls = {task_type.url for task_type in self.task_types}
+        self.queries = {task_type.query for task_type in self.task_types}
+
+        # (index, count) of the server group tracked by this instance
+        self.partition = partition
+
+        servers = list(servers)
+        if names is None: names = servers
+        if capacity is None: capacity = len(servers)
+        padding = capacity - len(servers)
+        self.assign([int(server) for server in servers] + [0] * padding, \
+            list(names) + [None] * padding, 0)
+
+    # Lay out servers by slot from their HAProxy ids (0 = free slot)
+    def assign(self, keys, names, generation):
+        self.keys = np.array(keys, dtype = np.int64)
+        self.active = self.keys > 0
+        self.servers = [str(key) if key else None for key in keys]
+        # HAProxy server names, also the libvirt domain names
+        self.names = [name if key else None for (key, name) in zip(keys, names)]
+        self.server_ids = {server: srv for (srv, server) \
+            in enumerate(self.servers) if server is not None}
+        self.srv_values = self.keys.astype(float)
+        # Server table generation this layout was read from
+        self.generation = generation
+
+# SharedState keeps workload, CPU and predicted times in shared memory
+class SharedState:
+    def __init__(self, registry, name = None, shared = True, writers = 1):
+        self.registry = registry
+        # Ingestion workers, each owning one workload row
+        self.writers = writers
+        # Reads that raced a writer and were retried (this process)
+        self.retries = 0
+
+        # Serializes registry updates between threads of this process
+        self.lock = threading.Lock()
+
+        # Layout: seq[W + 2], srv_keys[S] (int64), names[S x NAME_LEN] (uint8),
+        # workload[W x S], cpu[S], predicted[T x S] (float64)
+        srv_count = len(registry.servers)
+        self.header = 8 * (writers + 2) + (8 + NAME_LEN) * srv_count
+        size = self.header + 8 * ((writers + 1) * srv_count \
+            + len(registry.tasks) * srv_count)
+        # Plain process memory when nothing else needs to attach
+        if not shared:
+            self.shm = None
+            self.buf = bytearray(size)
+        elif name is None:
+            self.shm = shared_memory.SharedMemory(create = True, size = size)
+            self.shm.buf[:size] = bytes(size)
+            self.buf = self.shm.buf
+        else:
+            self.shm = shared_memory.SharedMemory(name = name)
+            self.buf = self.shm.buf
+        self.attach()
+
+        # A new block starts with the registry's servers, attaching catches up
+        if name is None:
+            self.writeTable(registry.keys, registry.names)
+            registry.generation = int(self.seq[-1])
+        else: self.syncServers()
+
+    # NumPy views onto the shared block
+    def attach(self):
+        srv_count = len(self.registry.servers)
+        # Generation of each workload row (taskEvent shards), of cpu
+        # (cpuUsage) and of the server table (discovery), odd while the
+        # single writer of that row is mid-update
+        self.seq = np.ndarray(self.writers + 2, dtype = np.int64, \
+            buffer = self.buf)
+        # HAProxy id (0 = free) and name of the server in each slot
+        self.srv_keys = np.ndarray(srv_count, dtype = np.int64, \
+            buffer = self.buf, offset = 8 * (self.writers + 2))
+        self.srv_names = np.ndarray((srv_count, NAME_LEN), dtype = np.uint8, \
+            buffer = self.buf, offset = 8 * (self.writers + 2 + srv_count))
+        data = np.ndarray((self.writers + 1 + len(self.registry.tasks), \
+            srv_count), dtype = np.float64, \
+            buffer = self.buf, offset = self.header)
+        # Expected response time of backend servers (Summation of PRTs),
+        # split into one row per ingestion worker and summed by readers
+        self.workloads = data[:self.writers]
+        # CPU utilization of backend servers
+        self.cpu = data[self.writers]
+        # Rows = Task type, Columns = Server (written by comms only)
+        self.predicted = data[self.writers + 1:]
+        self.bindWriter(0)
+
+    # Select the workload row this process writes
+    def bindWriter(self, writer):
+        self.writer = writer
+        self.workload = self.workloads[writer]
+
+    # Spawned processes reattach to the same block by name
+    def __getstate__(self):
+        return (self.registry, self.shm.name, self.writers)
+
+    def __setstate__(self, state):
+        registry, name, writers = state
+        self.__init__(registry, name, writers = writers)
+
+    # Seqlock write of one entry of this process's workload row
+    def addWorkload(self, srv, delta):
+        self.seq[self.writer] += 1
+        self.workload[srv] += delta
+        self.seq[self.writer] += 1
+
+    # Seqlock write of a batch's combined workload changes
+    def addWorkloads(self, deltas):
+        self.seq[self.writer] += 1
+        self.workload += deltas
+        self.seq[self.writer] += 1
+
+    # Total over all workers (unsynchronized, for diagnostics and records)
+    def getWorkload(self, srv):
+        return float(self.workloads[:, srv].sum())
+
+    # Seqlock write of one CPU entry
+    def setCpu(self, srv, value):
+        self.seq[self.writers] += 1
+        self.cpu[srv] = value
+        self.seq[self.writers] += 1
+
+    def getCpu(self, srv):
+        return float(self.cpu[srv])
+
+    def getPredicted(self, task, srv):
+        return float(self.predicted[task, srv])
+
+    # Seqlock write of the server table, callers hold self.lock or own the block
+    def writeTable(self, keys, names):
+        self.seq[-1] += 1
+        self.srv_keys[:] = keys
+        self.srv_names[:] = 0
+        for (srv, name) in enumerate(names):
+            if name is None: continue
+            encoded = name.encode()[:NAME_LEN]
+            self.srv_names[srv, :len(encoded)] = np.frombuffer(encoded, np.uint8)
+        self.seq[-1] += 1
+
+    # Keep servers in their slots, free the departed and fill free slots with
+    # the new (discovery is the only writer)
+    def publishServers(self, servers):
+        with self.lock:
+            keys = self.srv_keys.copy()
+            names = list(self.registry.names)
+            wanted = dict(servers)
+            for srv in np.flatnonzero(keys):
+                if keys[srv] not in wanted: keys[srv] = 0
+            present = set(keys.tolist())
+            for (key, name) in servers:
+                if key in present or not servable(key): continue
+                free = np.flatnonzero(keys == 0)
+                if not len(free):
+                    print(f'No free server slot for {name} (MAX_SERVERS).')
+                    continue
+                keys[free[0]] = key
+                names[free[0]] = name
+            if (keys == self.srv_keys).all(): return
+            self.writeTable(keys, names)
+
+    # Refresh the registry if the server table moved on
+    def syncServers(self):
+        with self.lock:
+            while True:
+                generation = int(self.seq[-1])
+                if generation == self.registry.generation: return
+                if not generation & 1:
+                    keys = self.srv_keys.tolist()
+                    names = [bytes(name).rstrip(b'\0').decode() \
+                        for name in self.srv_names]
+                    if self.seq[-1] == generation: break
+                self.retries += 1
+                time.sleep(0)
+            self.registry.assign(keys, names, generation)
+
+    # Consistent copies of workload and CPU, retried if a writer interleaved
+    def snapshot(self):
+        while True:
+            generation = self.seq.copy()
+            if not (generation & 1).any():
+                workload = self.workloads.sum(axis = 0)
+                cpu_usage = self.cpu.copy()
+                if (self.seq == generation).all(): return workload, cpu_usage
+            self.retries += 1
+            time.sleep(0)
+
+    def close(self):
+        self.seq = self.workload = self.workloads = self.cpu = None
+        self.srv_keys = self.srv_names = None
+        self.predicted = self.buf = None
+        if self.shm is not None: self.shm.close()
+
+    def unlink(self):
+        if self.shm is not None: self.shm.unlink()
+
+# ServerView reports server slots that changed since its owner last looked
+class ServerView:
+    def __init__(self, state):
+        self.state = state
+        self.keys = state.registry.keys.copy()
+        self.generation = state.registry.generation
+
+    # Slots whose server was added, removed or replaced (usually none)
+    def changed(self):
+        state = self.state
+        if state.seq[-1] == self.generation: return ()
+        state.syncServers()
+        registry = state.registry
+        slots = np.flatnonzero(registry.keys != self.keys)
+        self.keys = registry.keys.copy()
+        self.generation = registry.generation
+        return slots
+
+# FeatureBlock is the model input layout shared by every task type
+class FeatureBlock:
+    # Column order produced by pd.get_dummies() during training
+    NUMERIC = ['Size', 'SizeStdev', 'Time', 'TimeStdev', 'Server', 'Workload', \
+        'CPU']
+    CATEGORICAL = ['Method', 'URL', 'Query', 'Content']
+
+    def __init__(self, profile_matrix):
+        self.tasks = list(profile_matrix.keys())
+        rows = []
+        for task_key in self.tasks:
+            task = profile_matrix[task_key]
+            rows.append({
+                'Size' : float(task.avg_size),
+                'SizeStdev' : float(task.size_stdev),
+                'Time' : float(task.avg_time),
+                'TimeStdev' : float(task.time_stdev),
+                'Method' : task.method,
+                'URL' : task.url,
+                'Query' : task.query,
+                'Content' : task.content
+            })
+
+        # One-hot columns are sorted per category ('NULL' encodes as empty)
+        self.columns = list(self.NUMERIC)
+        for category in self.CATEGORICAL:
+            values = sorted({row[category].replace('NULL', '') for row in rows})
+            self.columns += [f'{category}_{value}' for value in values]
+        self.columns.remove('Query_')
+        index = {column: i for (i, column) in enumerate(self.columns)}
+
+        # Rows = Task type, dynamic columns are left at zero
+        self.static = np.zeros((len(self.tasks), len(self.columns)))
+        for (row_index, row) in enumerate(rows):
+            for column in ['Size', 'SizeStdev', 'Time', 'TimeStdev']:
+                self.static[row_index, index[column]] = row[column]
+            for category in self.CATEGORICAL:
+                column = f'{category}_{row[category].replace("NULL", "")}'
+                if column in index: self.static[row_index, index[column]] = 1.
+
+        self.srv_col = index['Server']
+        self.wl_col = index['Workload']
+        self.cpu_col = index['CPU']
+        # Input scaling applied as rows are built (identity until fused)
+        self.mean = np.zeros(len(self.columns))
+        self.scale = np.ones(len(self.columns))
+
+    # Stack one copy of the static block per server and fill in its metrics
+    def build(self, servers, workload, cpu_usage):
+        task_count = len(self.tasks)
+        task_indices = np.tile(np.arange(task_count), len(servers))
+        return self.rows(task_indices, \
+            np.repeat([float(server) for server in servers], task_count), \
+            np.repeat([workload[server] for server in servers], task_count), \
+            np.repeat([cpu_usage[server] for server in servers], task_count))
+
+    # Static rows of the given task types with per-row server metrics
+    def rows(self, task_indices, srv_values, wl_values, cpu_values):
+        input_data = self.static[task_indices]
+        for (column, values) in ((self.srv_col, srv_values), \
+            (self.wl_col, wl_values), (self.cpu_col, cpu_values)):
+            input_data[:, column] = \
+                (values - self.mean[column]) / self.scale[column]
+        return input_data
+
+    # Scale the static block once, server metrics are scaled per row from
+    # here on. Rows then match x_scaler.transform() of unfused rows.
+    def fuse(self, x_scaler):
+        self.scale, self.mean = scalerAffine(x_scaler)
+        self.static = (self.static - self.mean) / self.scale
+
+# PredictionCache memoizes every task type's response time by server and
+# quantized metrics, one entry per server state
+class PredictionCache:
+    def __init__(self, size = CACHE_SIZE, wl_bucket = WL_BUCKET, \
+        cpu_bucket = CPU_BUCKET):
+        self.size = size
+        self.wl_bucket = wl_bucket
+        self.cpu_bucket = cpu_bucket
+        # Least recently used entries first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Snap metrics to the center of their bucket
+    def quantize(self, values, width):
+        if width <= 0: return values
+        return np.round(values / width) * width
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size: self.entries.popitem(last = False)
+
+# Snapshot double-buffers the serialized whitelist between worker and comms
+class Snapshot:
+    def __init__(self):
+        self.buffers = [None, None]
+        self.front = 0
+        self.generation = 0
+        self.time = None
+        self.cond = threading.Condition()
+        # Front buffer was served after a missed deadline
+        self.stale = False
+        self.timeouts = 0
+        self.stale_age = 0.
+        self.max_stale_age = 0.
+        # Generation in /Whitelist/whitelist.csv and LB connections reading it
+        # (between handshake '1' and '2'), kept by the comms loop
+        self.written = None
+        self.holders = 0
+
+    # Fill the back buffer, then flip it to the front
+    def publish(self, data):
+        back = 1 - self.front
+        self.buffers[back] = data
+        with self.cond:
+            self.front = back
+            self.generation += 1
+            self.time = time.time()
+            self.stale = False
+            self.cond.notify_all()
+
+    # Wait up to timeout for a generation newer than the given one
+    def wait(self, generation, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.generation > generation, \
+                timeout)
+
+    # Record that the front buffer is being served past its deadline
+    def markStale(self):
+        with self.cond:
+            self.stale = True
+            self.timeouts += 1
+            self.stale_age = time.time() - self.time
+            self.max_stale_age = max(self.max_stale_age, self.stale_age)
+
+    # Most recently finished whitelist and its generation
+    def latest(self):
+        with self.cond:
+            return self.buffers[self.front], self.generation
+
+    # Seconds since the front buffer was published (infinite before any)
+    def age(self):
+        with self.cond:
+            if self.time is None: return math.inf
+            return time.time() - self.time
+
+# LBConnection is one load balancer's place in the whitelist handshake
+class LBConnection:
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        # Generation seen at its '1', and when that arrived, while it waits
+        self.generation = None
+        self.start = None
+        # Reading the whitelist file until its '2'
+        self.holding = False
+
+# PartitionLink is the connection between a partition and the merge instance
+class PartitionLink:
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        # Serializes frames sent by the worker thread (partition side)
+        self.lock = threading.Lock()
+        # Partition index named by the first frame, bytes of an unfinished
+        # frame and whether a whitelist arrived since the last merge (merge side)
+        self.index = None
+        self.buffer = b''
+        self.fresh = False
+
+# LogTailer reads everything appended to the log since its last read, sleeping
+# on inotify (or a short poll) in between. It follows the path across rotation
+# and truncation, and its position is the file identity (device, inode) with
+# the byte offset after the last complete line read.
+class LogTailer:
+    def __init__(self, path, checkpoint = None):
+        self.path = path
+        self.checkpoint = checkpoint
+        self.file = None
+        self.fd = None
+        self.reopen()
+
+    # Open whatever file is at the path now, from its start. Without one
+    # (not created yet) the tailer reads nothing until it appears.
+    def reopen(self):
+        if self.file is not None: self.file.close()
+        try:
+            self.file = open(self.path, 'rb')
+        except FileNotFoundError:
+            self.file = None
+            self.identity = None
+            self.timeout = TAIL_POLL
+            self.seek(0)
+            return
+        stat = os.fstat(self.file.fileno())
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.seek(0)
+        self.fd = inotifyWatch(self.path, self.fd)
+        self.timeout = TAIL_INTERVAL if self.fd is None else TAIL_POLL
+
+    # Continue from an offset, nothing before it is left to apply
+    def seek(self, offset):
+        if self.file is not None: self.file.seek(offset)
+        self.offset = offset
+        # Start of a line whose end has not been written yet
+        self.pending = b''
+        self.applied = self.position()
+
+    def size(self):
+        if self.file is None: return 0
+        return os.fstat(self.file.fileno()).st_size
+
+    # (device, inode, offset) of the next line, None without a file
+    def position(self):
+        if self.file is None: return None
+        return (*self.identity, self.offset)
+
+    # Mark every line read so far as applied, saving the position to the
+    # checkpoint if one is due
+    def commit(self):
+        self.applied = self.position()
+        if self.checkpoint is not None and self.applied is not None:
+            self.checkpoint.save(self.applied)
+
+    # Complete lines from the next chunk appended since the last call,
+    # possibly none. A missing log is looked for again.
+    def read(self):
+        if self.file is None:
+            self.reopen()
+            if self.file is None: return []
+        data = self.file.read(TAIL_CHUNK)
+        if not data:
+            self.follow()
+            return []
+        data = self.pending + data
+        end = data.rfind(b'\n') + 1
+        self.pending = data[end:]
+        self.offset += end
+        return data[:end].decode(errors = 'replace').splitlines(keepends = True)
+
+    # Complete lines between two offsets, one cut by the start is dropped.
+    # Leaves the file anywhere, seek() before reading on.
+    def span(self, start, end):
+        if self.file is None: return []
+        begin = max(start - 1, 0)
+        self.file.seek(begin)
+        data = self.file.read(end - begin)
+        if start > 0: data = data.partition(b'\n')[2]
+        data = data[:data.rfind(b'\n') + 1]
+        return data.decode(errors = 'replace').splitlines(keepends = True)
+
+    # At the end of the file: switch to a new file at the path (rotated away)
+    # or start over if the file shrank below what was read (truncated)
+    def follow(self):
+        try: stat = os.stat(self.path)
+        except FileNotFoundError: return
+        if (stat.st_dev, stat.st_ino) != self.identity:
+            self.reopen()
+            stats.counters['rotated'] = stats.counters.get('rotated', 0) + 1
+        elif stat.st_size < self.offset + len(self.pending):
+            self.seek(0)
+            stats.counters['truncated'] = stats.counters.get('truncated', 0) + 1
+
+    # Block until the log changes or the timeout passes
+    def wait(self):
+        if self.fd is None or self.file is None:
+            time.sleep(self.timeout)
+            return
+        readable, _, _ = select.select([self.fd], [], [], self.timeout)
+        if readable: self.drain()
+
+    # Discard queued inotify events, only their arrival matters
+    def drain(self):
+        try:
+            while os.read(self.fd, 4096): pass
+        except BlockingIOError:
+            pass
+
+    # Close the log, saving the position of the last applied line
+    def close(self):
+        if self.checkpoint is not None and self.applied is not None:
+            self.checkpoint.save(self.applied, force = True)
+        if self.fd is not None: os.close(self.fd)
+        self.fd = None
+        if self.file is not None: self.file.close()
+
+# LogCheckpoint saves a LogTailer position to a file every so often, so a
+# restarted worker resumes where it left off. Lines applied after the last
+# save are applied again if the worker dies without a final save.
+class LogCheckpoint:
+    def __init__(self, path, interval = CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.saved = None
+        self.save_time = time.monotonic()
+
+    # (device, inode, offset) of the last save, None if there is none
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                dev, ino, offset = (int(field) for field in file.read().split())
+        except (OSError, ValueError):
+            return None
+        return dev, ino, offset
+
+    # Replace the saved position (at most once per interval unless forced)
+    def save(self, position, force = False):
+        if position == self.saved: return
+        now = time.monotonic()
+        if not force and now - self.save_time < self.interval: return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write('%d %d %d\n' % position)
+        os.replace(temp_path, self.path)
+        self.saved = position
+        self.save_time = now
+
+# SocketFeed receives log lines as datagrams over UDP or a Unix socket
+# (rsyslog forwarding, HAProxy log targets) and reads like a LogTailer.
+# Datagrams cannot be replayed, so it has no position to checkpoint.
+class SocketFeed:
+    def __init__(self, feed):
+        kind, address = feed
+        if kind == 'unix':
+            family = socket.AF_UNIX
+            # A socket file left behind by an earlier run
+            try: os.unlink(address)
+            except FileNotFoundError: pass
+        else:
+            host, port = address
+            family, _, _, _, address = socket.getaddrinfo(host, port, \
+                type = socket.SOCK_DGRAM)[0]
+        self.kind = kind
+        self.address = address
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, FEED_BUFFER)
+        self.sock.bind(address)
+        self.sock.setblocking(False)
+        self.fd = self.sock.fileno()
+        self.timeout = TAIL_POLL
+
+    # Lines of the datagrams queued since the last call, about TAIL_CHUNK
+    # bytes at most, possibly none
+    def read(self):
+        lines = []
+        size = 0
+        while size < TAIL_CHUNK:
+            try: data = self.sock.recv(FEED_DATAGRAM)
+            except BlockingIOError: break
+            size += len(data)
+            lines += syslogLines(data)
+        return lines
+
+    # Block until a datagram arrives or the timeout passes
+    def wait(self):
+        select.select([self.sock], [], [], self.timeout)
+
+    # Readiness clears once the datagrams are read, nothing to discard
+    def drain(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        if self.fd is None: return
+        self.sock.close()
+        self.fd = None
+        if self.kind == 'unix': os.unlink(self.address)
+
+# LatencyStats aggregates stage timings into fixed log-spaced histograms
+class LatencyStats:
+    # Bucket upper bounds in seconds: 1us to 10s, four per decade
+    BOUNDS = [10. ** (exponent / 4) for exponent in range(-24, 5)]
+
+    def __init__(self):
+        self.counts = {}
+        self.totals = {}
+        self.maxima = {}
+        # Non-timing values reported alongside the histograms
+        self.counters = {}
+        # Callables sampled when a summary is taken
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try: yield
+        finally: self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        bucket = bisect.bisect_left(self.BOUNDS, seconds)
+        with self.lock:
+            if stage not in self.counts:
+                self.counts[stage] = [0] * (len(self.BOUNDS) + 1)
+                self.totals[stage] = 0.
+                self.maxima[stage] = 0.
+            self.counts[stage][bucket] += 1
+            self.totals[stage] += seconds
+            self.maxima[stage] = max(self.maxima[stage], seconds)
+
+    # Upper bound of the bucket holding the q-th percentile
+    def percentile(self, stage, q):
+        counts = self.counts[stage]
+        target = q / 100 * sum(counts)
+        seen = 0
+        for (bucket, count) in enumerate(counts):
+            seen += count
+            if seen >= target and count:
+                if bucket == len(self.BOUNDS): return self.maxima[stage]
+                return min(self.BOUNDS[bucket], self.maxima[stage])
+        return 0.
+
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for stage in self.counts:
+                count = sum(self.counts[stage])
+                stages[stage] = {
+                    'count' : count,
+                    'mean' : self.totals[stage] / count,
+                    'p50' : self.percentile(stage, 50),
+                    'p95' : self.percentile(stage, 95),
+                    'p99' : self.percentile(stage, 99),
+                    'max' : self.maxima[stage]
+                }
+            counters = dict(self.counters)
+            for (name, gauge) in self.gauges.items(): counters[name] = gauge()
+            return {'time' : time.time(), 'stages' : stages, \
+                'counters' : counters}
+
+    def dump(self, file):
+        json.dump(self.summary(), file, indent = 2)
+        file.write('\n')
+        file.flush()
+
+    # Dump from a signal handler. The handler may have interrupted this
+    # thread inside record() with the lock held, so another thread waits for it.
+    def dumpLater(self, file):
+        threading.Thread(target = self.dump, args = (file,), daemon = True).start()
+
+# Stage timings of this process
+stats = LatencyStats()
+
 def main():
-    with Manager() as m:
-        # Profiled information per task type
-        profile_matrix = {}
-        # Expected response time of backend servers
-        # (Summation of PRTs)
-        workload = m.dict()
-        # CPU utilization stamp at time of instance dispatch
-        cpu_usage = m.dict()
-        # Rows = Task type
-        # Columns = Server
-        predicted_time = m.dict()
-        # Key is task type and values are servers task is allowed to dispatch to
-        whitelist = {}
-        # Master Lock TM
-        wl_lock = Lock()    # Workload
-        pt_lock = Lock()    # Predicted Time
-        cpu_lock = Lock()   # CPU Usage
-        # GBDT model
-        model_path = CURR_PATH + '/Model/GBDT_Scaled_Norm.sav'
-        model = load(open(model_path, 'rb'))
-        # Input scaler
-        x_scaler_path = CURR_PATH + '/Model/xScaler.sav'
-        x_scaler = load(open(x_scaler_path, 'rb'))
-        # Output scaler
-        y_scaler_path = CURR_PATH + '/Model/yScaler.sav'
-        y_scaler = load(open(y_scaler_path, 'rb'))
-
-        init(profile_matrix, workload, cpu_usage, predicted_time, whitelist, m)
-
-        # ***
-        # print('Initial whitelist')
-        # for task in whitelist: print(f'\n{task}\n{whitelist[task]}\n')
-
-        # Multiprocessing mumbo jumbo
-        proc1 = Process(target = taskEvent, args = (profile_matrix, workload, \
-            cpu_usage, predicted_time, wl_lock, pt_lock, cpu_lock))
-        proc2 = Process(target = cpuUsage, args = (cpu_usage, cpu_lock))
-        proc3 = Process(target = comms, args = (profile_matrix, workload, \
-            cpu_usage, predicted_time, whitelist, wl_lock, pt_lock, cpu_lock, model, \
-            x_scaler, y_scaler))
-
-        # *** Debugging purposes
-        # proc4 = Process(target = debugPrint, args = (cpu_usage, cpu_lock, \
-        #     predicted_time, pt_lock, workload, wl_lock))
-
-        start_time = datetime.now()
-        print(f"Commencing Smartdrop [{start_time}].")
-
-        proc1.start()       # Start listening for task events
+    args = parseArgs()
+
+    # Merge instance: no model or state, only partitions and load balancers
+    if args.mode == 'merge':
+        print(f"Commencing Smartdrop merge [{datetime.now()}].")
+        mergeComms(args.merge, args.partitions)
+        return
+
+    # Profiled information per task type
+    profile_matrix = {}
+    # GBDT model
+    model_path = CURR_PATH + '/Model/GBDT_Scaled_Norm.sav'
+    model = load(open(model_path, 'rb'))
+    # Input scaler
+    x_scaler_path = CURR_PATH + '/Model/xScaler.sav'
+    x_scaler = load(open(x_scaler_path, 'rb'))
+    # Output scaler
+    y_scaler_path = CURR_PATH + '/Model/yScaler.sav'
+    y_scaler = load(open(y_scaler_path, 'rb'))
+
+    # Workload, CPU usage and predicted time (shared by all processes)
+    # Rows = Task type, Columns = Server, True if task may dispatch to server
+    state, whitelist = init(profile_matrix, shared = args.mode == 'process', \
+        writers = args.workers if args.mode == 'process' else 1, \
+        partition = args.partition)
+    # One-hot encoded model inputs per task type
+    features = FeatureBlock(profile_matrix)
+    if FUSE_SCALERS:
+        features.fuse(x_scaler)
+        checkFusion(profile_matrix, features, model, x_scaler, y_scaler)
+        x_scaler = None
+
+    # ***
+    # print('Initial whitelist')
+    # print(serialize(whitelist, state.registry))
+
+    start_time = datetime.now()
+    print(f"Commencing Smartdrop [{start_time}] ({args.mode} mode).")
+
+    # Single process, single event loop
+    if args.mode == 'asyncio':
+        try:
+            asyncio.run(asyncEngine(features, state, whitelist, \
+                model, x_scaler, y_scaler, args.feed))
+        finally:
+            state.close()
+        return
+
+    # Multiprocessing mumbo jumbo
+    partitioned = args.partition[1] > 1
+    startRecord()
+    # One log parser per shard of task IDs
+    proc1 = [Process(target = taskEvent, args = (state, shard, args.workers, \
+        args.feed)) for shard in range(args.workers)]
+    proc2 = Process(target = cpuUsage, args = (state,))
+    if partitioned:
+        proc3 = Process(target = partitionComms, args = (features, state, \
+            whitelist, model, x_scaler, y_scaler, args.merge))
+    else:
+        proc3 = Process(target = comms, args = (features, state, whitelist, \
+            model, x_scaler, y_scaler))
+
+    # *** Debugging purposes
+    # proc4 = Process(target = debugPrint, args = (state,))
+
+    # SIGUSR1 would otherwise end the parent without its cleanup below. The
+    # children inherit the ignore until they install their own stats handler
+    # (cpuUsage keeps no stats and never does).
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    try:
+        for proc in proc1:
+            proc.start()    # Start listening for task events
         proc2.start()       # Start observing hardware metrics
         proc3.start()       # Start listening for LB messages
         # proc4.start() # ***
-        proc1.join()
+        # kill -USR1 on the parent dumps every process's stats
+        signal.signal(signal.SIGUSR1, lambda signum, frame: \
+            forwardSignal(signum, proc1 + [proc3]))
+        for proc in proc1: proc.join()
         proc2.join()
         proc3.join()
         # proc4.join() # ***
-        proc1.terminate()   # Stop listening for task events
+    finally:
+        for proc in proc1:
+            proc.terminate()    # Stop listening for task events
         proc2.terminate()   # Stop observing hardware metrics
         proc3.terminate()   # Stop listening for LB messages
         # proc4.terminate() # ***
+        state.close()
+        state.unlink()
+
+# Pass a signal on to the given child processes
+def forwardSignal(signum, procs):
+    for proc in procs:
+        if proc.pid is not None: os.kill(proc.pid, signum)
 
 # Process 1
 # -----------------------------------------------------------------------------
-# Monitor task-related events
-def taskEvent(profile_matrix, workload, cpu_usage, predicted_time, wl_lock, 
-    pt_lock, cpu_lock):
-    record = {}
-    status_key = {'+' : 'new', '>' : 'complete', '-' : 'sent'}
-    methods = ['GET', 'POST']
+# Monitor task-related events, only those of this shard's task IDs
+def taskEvent(state, shard = 0, shards = 1, feed = None):
+    state.bindWriter(shard)
+    record = InFlightTable()
+    view = ServerView(state)
     error_count = 0
+    trackRecord(record)
+    signal.signal(signal.SIGUSR1, \
+        lambda signum, frame: stats.dumpLater(sys.stdout))
 
-    # Clear logs
-    task_event_path = '/var/log/apache_access.log'
-    os.system(f'truncate -s 0 {task_event_path}')
-    record_path = CURR_PATH + '/../logs/smartdrop.log'
+    # Terminated workers still save their log offset
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    with open(record_path, 'a') as record_file:
-        record_file.write(
-            'method,url,query,content,avg_size,size_stdev,avg_time,time_stdev,'
-            'server,workload,cpu_usage,predicted_time,actual_time\n'
-        )
-
-        with open(task_event_path, 'r') as task_events:
-            lines = logRead(task_events)
+    source = openSource(state, record, feed, shard, shards)
+    # Batch, replay and in-flight stats of this worker only
+    stats_path = workerStatsPath(state.registry, shard)
+    stats_time = time.time()
 
+    try:
+        with openRecord() as record_file:
             # MAIN LOOP: Parse log file
-            for line in lines:
-                new_instance = True
-                status = None
-                task_id = None
-                method = None # Don't know why we can't method, query, ... = None
-                url = None
-                query = None
-                content = None
-                server = None
-                error = None
-                actual_time = None
-
-                line = re.split(',|\s|\|', line)
-
-                # Status
-                try:
-                    status = status_key[line[0][0].replace(' ', '')]
-
-                    # # ***
-                    # print(f'Status parsed: {status}')
-
-                    if status == 'sent': continue
-                except IndexError:
-                    error_count += 1
-                    continue
-                except KeyError:
-                    error_count += 1
-                    continue
-
-                # Task ID
-                try:
-                    task_id = line[0][1:].replace(' ', '')
-
-                    # # ***
-                    # print(f'Task ID parsed: {task_id}')
+            for lines in logRead(source):
+                retireServers(record, state, view.changed())
+                reapRecord(record, state)
+                if lines:
+                    lines = ownLines(lines, state.registry, shard, shards)
+                    error_count += handleBatch(lines, state, record, record_file)
+                source.commit()
+                stats_time = writeStats(stats_path, stats_time)
+    finally:
+        source.close()
+
+# Lines of this worker's shard and, when partitioned, its servers
+def ownLines(lines, registry, shard = 0, shards = 1):
+    # New and completion events of a request hash to the same shard
+    if shards > 1:
+        lines = [line for line in lines if shardOf(line, shards) == shard]
+    # Other partitions' new tasks are not tracked here. Their completions
+    # are dropped by handleEvent() as unknown task ids.
+    if registry.partition[1] > 1:
+        lines = [line for line in lines if line[:1] != '+' \
+            or lineServer(line) in registry.server_ids]
+    return lines
+
+# Where a worker's events come from: the feed socket if there is one, else the
+# access log resumed from the worker's checkpoint
+def openSource(state, record, feed = None, shard = 0, shards = 1):
+    if feed is not None: return SocketFeed(feed)
+    checkpoint = LogCheckpoint(checkpointPath(state.registry, shard))
+    return resumeLog(checkpoint, state, record, shard, shards)
+
+# Open the access log where this worker's checkpoint left off (its start if the
+# log was rotated or truncated meanwhile, its end without a checkpoint) and
+# rebuild the requests in flight there from the REPLAY_BYTES before it
+def resumeLog(checkpoint, state, record, shard = 0, shards = 1):
+    tailer = LogTailer(TASK_EVENT_PATH, checkpoint)
+    saved = checkpoint.load()
+    size = tailer.size()
+    if saved is None: start = size
+    elif saved[:2] == tailer.identity and saved[2] <= size: start = saved[2]
+    else: start = 0
+
+    with stats.timer('replay'):
+        lines = tailer.span(max(start - REPLAY_BYTES, 0), start)
+        handleBatch(ownLines(lines, state.registry, shard, shards), state, \
+            record, None)
+    tailer.seek(start)
+    stats.counters['replayed'] = len(lines)
+    return tailer
+
+# Apply a batch of log lines, publishing their workload changes in one write
+# and their completion records in another. Returns the number of lines that
+# could not be applied. Without a record file (replay) completions are not
+# recorded again.
+def handleBatch(lines, state, record, record_file):
+    deltas = np.zeros(len(state.registry.servers))
+    rows = None if record_file is None else []
+    error_count = 0
 
-                    if task_id in record:
-                        method = record[task_id].method
-                        url = record[task_id].url
-                        query = record[task_id].query
-                        content = record[task_id].content
-                        server = record[task_id].server
-                        new_instance = False
+    with stats.timer('batch'):
+        for line in lines:
+            if not handleEvent(line, state, record, rows, deltas):
+                error_count += 1
+        state.addWorkloads(deltas)
+        # One O_APPEND write, whole batches of shards never interleave
+        if rows: record_file.write(''.join(rows).encode())
+    return error_count
+
+# Apply one log line to the batch's workload deltas and the in-flight record,
+# adding completions to the batch's record rows. False on error.
+def handleEvent(line, state, record, rows, deltas):
+    registry = state.registry
+
+    # Status, sent events are dropped before any splitting
+    status = line[:1]
+    if status == '-': return True
+    if status not in STATUS_KEY: return False
+    status = STATUS_KEY[status]
+
+    tokens = DELIMITERS.split(line)
+    task_id = tokens[0][1:]
+
+    # # ***
+    # print(f'Status parsed: {status}, Task ID parsed: {task_id}')
+
+    # Insert task
+    if status == 'new':
+        if task_id in record: return False
+        ids = parseLine(line, tokens, registry)
+        if ids is None: return False
+        task, srv = ids
+
+        deltas[srv] += registry.avg_time[task]
+        # Workload as it will be once this batch is published
+        workload = state.getWorkload(srv) + deltas[srv]
+
+        # # ***
+        # print(f'Current workload: {workload}')
+        # print(f'Current CPU: {state.getCpu(srv)}\n')
+
+        record.add(task_id, task, srv, workload, state.getCpu(srv), \
+            state.getPredicted(task, srv))
+
+    # Task completion
+    else:
+        if task_id not in record: return False
+
+        # Response time (MICROSECONDS)
+        try: actual_time = tokens[6]
+        except IndexError: return False
+        try: float(actual_time)
+        except ValueError:
+            actual_time = 'NULL'
+
+        row = record.pop(task_id)
+        deltas[record.srv[row]] -= registry.avg_time[record.task[row]]
+        if rows is not None:
+            rows.append(f'{record.toList(row, registry)},{actual_time}\n')
+
+    return True
+
+# Shard owning a log line, by a hash of its task ID stable across processes
+def shardOf(line, shards):
+    task_id = TASK_ID.match(line, 1).group()
+    return zlib.crc32(task_id.encode()) % shards
+
+# Forget in-flight requests and this worker's workload on replaced server slots
+def retireServers(record, state, slots):
+    for srv in slots:
+        record.dropServer(srv)
+        state.addWorkload(srv, -state.workload[srv])
+
+# Drop in-flight requests whose completion line never arrived
+def reapRecord(record, state):
+    rows = record.expire()
+    if not rows: return
+    registry = state.registry
+    for row in rows:
+        state.addWorkload(record.srv[row], -registry.avg_time[record.task[row]])
+    stats.counters['reaped'] = stats.counters.get('reaped', 0) + len(rows)
+
+# Report in-flight table size with the latency stats
+def trackRecord(record):
+    stats.gauges['inflight'] = record.__len__
+    stats.gauges['inflight_capacity'] = lambda: record.capacity
+    stats.gauges['inflight_bytes'] = record.footprint
 
-                        # # ***
-                        # print('Task ID found in record.')
+# Process 2
+# -----------------------------------------------------------------------------
+# Monitor CPU utilization of backend server
+def cpuUsage(state): 
+    conn = openHypervisor()
+    view = ServerView(state)
+    while True:
+        # Departed servers read as idle
+        for srv in view.changed(): state.setCpu(srv, 0.)
+        registry = state.registry
 
-                    else:
-                        method, url, query, content, server, error = parseLine(line, \
-                            profile_matrix)
+        for srv in np.flatnonzero(registry.active):
+            domain = conn.lookupByName(registry.names[srv])
 
-                        if error == True:
-                            error_count += 1
-                            continue
-                except IndexError:
-                    error_count += 1
-                    continue                
+            time1 = time.time()
+            info1 = domain.info()
+            time.sleep(1.25)
+            time2 = time.time()
+            info2 = domain.info()
 
-                # Response time (MICROSECONDS)
-                if not new_instance:
+            state.setCpu(srv, cpuPercent(time1, info1, time2, info2))
 
-                    # # ***
-                    # print('Not a new instance.')
+# Process 3
+# -----------------------------------------------------------------------------
+# Send whitelist to every connected load balancer
+def comms(features, state, whitelist, model, x_scaler, y_scaler):
+    # Latest finished whitelist, filled by the worker thread
+    snapshot = Snapshot()
+    snapshot.publish(serialize(whitelist, state.registry))
+    # Set to request an early refresh
+    refresh = threading.Event()
+    # Written by the worker after each publish to wake the selector
+    wake_recv, wake_send = socket.socketpair()
+    wake_send.setblocking(False)
+
+    worker = threading.Thread(target = whitelistWorker, args = (features, state, \
+        whitelist, model, x_scaler, y_scaler, snapshot, refresh, \
+        lambda: wakeSelector(wake_send)), daemon = True)
+    worker.start()
+
+    # $ kill -USR1 <pid> prints the latency histograms
+    signal.signal(signal.SIGUSR1, \
+        lambda signum, frame: stats.dumpLater(sys.stdout))
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s, \
+        selectors.DefaultSelector() as selector, wake_recv, wake_send:
+        s.bind((HOST, PORT))
 
+        s.listen()
+        s.setblocking(False)
+        selector.register(s, selectors.EVENT_READ)
+        selector.register(wake_recv, selectors.EVENT_READ)
+        clients = []
+
+        # Main loop
+        while True:
+            for (key, _) in selector.select(waitTimeout(clients, snapshot)):
+                if key.fileobj is s:
+                    acceptClient(s, selector, clients)
+                elif key.fileobj is wake_recv:
+                    wake_recv.recv(4096)
+                else:
                     try:
-                        actual_time = line[6].replace(' ', '')
-
-                        # # ***
-                        # print(f'Response time parsed: {actual_time}')
-
-                        try: float(actual_time)
-                        except ValueError:
-                            actual_time = 'NULL'
-                    except IndexError:
-                        error_count += 1
-                        continue
+                        handshake(key.data, snapshot, refresh)
+                    except (RuntimeError, ConnectionError):
+                        dropClient(key.data, selector, clients, snapshot)
+
+            # Every waiting LB is answered from the same refresh
+            for client in serveClients(clients, snapshot):
+                dropClient(client, selector, clients, snapshot)
+
+# Register a new LB connection with the selector
+def acceptClient(s, selector, clients):
+    conn, addr = s.accept()
+    print('Connected by: ', addr)
+    conn.setblocking(False)
+    client = LBConnection(conn, addr)
+    selector.register(conn, selectors.EVENT_READ, client)
+    clients.append(client)
+
+# Advance one LB through the handshake on an incoming message
+def handshake(client, snapshot, refresh):
+    # Receive 1 or 2
+    receiveMessage(client.conn)
+
+    if client.holding:
+        # Send 2
+        client.holding = False
+        snapshot.holders -= 1
+        sendMessage(client.conn, b'2')
+    elif client.generation is None:
+        client.start = time.perf_counter()
+        _, client.generation = snapshot.latest()
+        # A whitelist from this refresh interval is served at once (as if
+        # waited for), an older one asks for a fresh whitelist and falls back
+        # to the last good one
+        if snapshot.age() < REFRESH_INTERVAL: client.generation -= 1
+        else: refresh.set()
+
+# Answer LBs whose whitelist is fresh or whose deadline passed, returns the
+# connections that broke
+def serveClients(clients, snapshot):
+    # Nothing to serve before the first whitelist (merge instance)
+    if snapshot.generation == 0: return []
+    now = time.perf_counter()
+    ready = []
+    for client in clients:
+        if client.generation is None: continue
+        if snapshot.generation > client.generation: ready.append(client)
+        elif now - client.start >= COMPUTE_DEADLINE:
+            snapshot.markStale()
+            ready.append(client)
+    if not ready: return []
+
+    # Offload latest finished whitelist (kept while another LB is reading it)
+    offload(snapshot)
+
+    broken = []
+    for client in ready:
+        stats.record('deadline_wait', now - client.start)
+        client.generation = None
+        try:
+            # Send 1
+            sendMessage(client.conn, b'1')
+        except (RuntimeError, ConnectionError):
+            broken.append(client)
+            continue
+        client.holding = True
+        snapshot.holders += 1
+        stats.record('handshake', time.perf_counter() - client.start)
+    return broken
+
+# Seconds until the earliest waiting LB's deadline, None if none is waiting
+def waitTimeout(clients, snapshot):
+    # Deadlines do not apply before the first whitelist
+    if snapshot.generation == 0: return None
+    starts = [client.start for client in clients if client.generation is not None]
+    if not starts: return None
+    return max(0., min(starts) + COMPUTE_DEADLINE - time.perf_counter())
+
+# Forget a broken LB connection, releasing its hold on the whitelist file
+def dropClient(client, selector, clients, snapshot):
+    print('Connection broken: ', client.addr)
+    if client.holding: snapshot.holders -= 1
+    selector.unregister(client.conn)
+    client.conn.close()
+    clients.remove(client)
+
+# Nudge a select() loop awake from another thread
+def wakeSelector(sock):
+    try: sock.send(b'\0')
+    except BlockingIOError: pass
+
+# Recalculate the whitelist periodically or when comms asks for it
+def whitelistWorker(features, state, whitelist, model, x_scaler, y_scaler, \
+    snapshot, refresh, notify = None):
+    # Server inputs (Workload, CPU) used for the latest predictions
+    last_input = np.full((2, len(state.registry.servers)), np.nan)
+    # Predictions by task, server and quantized workload/CPU
+    cache = PredictionCache()
+    view = ServerView(state)
+    stats_time = time.time()
+    discovery_time = time.time()
 
-                # Insert task
-                if status == 'new':
+    while True:
+        refresh.wait(REFRESH_INTERVAL)
+        refresh.clear()
+
+        if time.time() - discovery_time >= DISCOVERY_INTERVAL:
+            discoverServers(state)
+            discovery_time = time.time()
+
+        snapshot.publish(refreshWhitelist(features, state, whitelist, model, \
+            x_scaler, y_scaler, last_input, cache, view))
+        if notify is not None: notify()
+        stats_time = reportStats(state, snapshot, cache, stats_time)
+
+# Calculate and serialize the whitelist (on a lock-free copy of the inputs)
+def refreshWhitelist(features, state, whitelist, model, x_scaler, y_scaler, \
+    last_input, cache, view = None):
+    start = time.perf_counter()
+
+    whiteAlg(features, state, model, x_scaler, y_scaler, whitelist, \
+        last_input, cache, view)
+
+    # ***
+    # print(serialize(whitelist, state.registry))
+
+    with stats.timer('serialize'): data = serialize(whitelist, state.registry)
+    stats.record('refresh', time.perf_counter() - start)
+    return data
+
+# Publish the backend's current servers to every process
+def discoverServers(state):
+    with stats.timer('discovery'): servers = detectServers()
+    # Keep the last known servers while the runtime API is unreachable
+    if servers: state.publishServers(ownServers(servers, \
+        state.registry.partition))
+
+# Write the latest snapshot for HAProxy if it changed and no LB is reading it
+def offload(snapshot):
+    if snapshot.holders: return
+    data, generation = snapshot.latest()
+    if generation != snapshot.written:
+        with stats.timer('fileWrite'): fileWrite(data)
+        snapshot.written = generation
+
+# Update counters and periodically offload latency histograms
+def reportStats(state, snapshot, cache, stats_time):
+    stats.counters.update({
+        'cache_hits' : cache.hits,
+        'cache_misses' : cache.misses,
+        # 1 while the whitelist being served is past its deadline
+        'stale' : int(snapshot.stale),
+        'timeouts' : snapshot.timeouts,
+        'stale_age' : snapshot.stale_age,
+        'max_stale_age' : snapshot.max_stale_age,
+        'snapshot_retries' : state.retries
+    })
+
+    return writeStats(STATS_PATH, stats_time)
+
+# Overwrite path with this process's stats once STATS_INTERVAL has passed
+# since stats_time, returns when they were last written
+def writeStats(path, stats_time):
+    if time.time() - stats_time >= STATS_INTERVAL:
+        with open(path, 'w') as file: stats.dump(file)
+        stats_time = time.time()
+    return stats_time
+
+# Asyncio Engine
+# -----------------------------------------------------------------------------
+# Log tailing, CPU sampling and LB handshakes as coroutines on one event loop.
+# State lives in this process, only whitelist calculation leaves the loop.
+async def asyncEngine(features, state, whitelist, model, \
+    x_scaler, y_scaler, feed = None):
+    snapshot = Snapshot()
+    snapshot.publish(serialize(whitelist, state.registry))
+    refresh = asyncio.Event()
+    # Notified after each publish
+    published = asyncio.Condition()
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, stats.dump, sys.stdout)
+
+    server = await asyncio.start_server(lambda reader, writer: asyncComms( \
+        reader, writer, snapshot, refresh, published), HOST, PORT)
+
+    async with server:
+        await asyncio.gather(
+            asyncTaskEvent(state, feed),
+            asyncCpuUsage(state),
+            asyncWorker(features, state, whitelist, model, x_scaler, y_scaler, \
+                snapshot, refresh, published),
+            server.serve_forever()
+        )
 
-                    # # ***
-                    # print('New status recognized.')
+# Monitor task-related events
+async def asyncTaskEvent(state, feed = None):
+    record = InFlightTable()
+    view = ServerView(state)
+    error_count = 0
+    trackRecord(record)
 
-                    try:
-                        key = f'{method},{url},{query},{content}'
-                        task_type = profile_matrix[key]
-                        wl_lock.acquire()
-                        workload[server] += float(task_type.avg_time)
-                        cpu_lock.acquire()
-
-                        # # ***
-                        # print(f'Current workload: {workload[server]}')
-                        # print(f'Current CPU: {cpu_usage[server]}\n')
-
-                        record[task_id] = Instance(task_type, server, \
-                            workload[server], cpu_usage[server], \
-                            predicted_time[key][server])
-                        cpu_lock.release()
-                        wl_lock.release()                        
-                    except KeyError:
-                        error_count += 1
-
-                # Task completion
-                else:
+    startRecord()
+    source = openSource(state, record, feed)
 
-                    # # ***
-                    # print('Completion status recognized.')
+    loop = asyncio.get_running_loop()
+    with openRecord() as record_file:
+        # Set by the loop when inotify or the feed socket reports data
+        changed = asyncio.Event()
+        reader = source.fd
+        if reader is not None: loop.add_reader(reader, changed.set)
 
-                    try:
-                        record_entry = record[task_id].toList()
-                        key = f'{method},{url},{query},{content}'
-                        task_type = profile_matrix[key]
-                        wl_lock.acquire()
-                        workload[server] -= float(task_type.avg_time)
-                        wl_lock.release()
-                        record_file.write(f'{record_entry},{actual_time}\n')
-                        del record[task_id]
-                    except KeyError:
-                        error_count += 1
+        try:
+            while True:
+                retireServers(record, state, view.changed())
+                reapRecord(record, state)
+                source.commit()
+                lines = source.read()
+                # A log missing at startup is only watched once it appears
+                if source.fd != reader:
+                    reader = source.fd
+                    loop.add_reader(reader, changed.set)
+                if not lines:
+                    # A timer rather than wait_for, which can swallow a
+                    # cancellation that races the event
+                    timer = loop.call_later(source.timeout, changed.set)
+                    await changed.wait()
+                    timer.cancel()
+                    changed.clear()
+                    if source.fd is not None: source.drain()
+                    continue
+                lines = ownLines(lines, state.registry)
+                error_count += handleBatch(lines, state, record, record_file)
+                # Let handshakes in between batches
+                await asyncio.sleep(0)
+        finally:
+            if reader is not None: loop.remove_reader(reader)
+            source.close()
 
-# Process 2
-# -----------------------------------------------------------------------------
 # Monitor CPU utilization of backend server
-def cpuUsage(cpu_usage, cpu_lock): 
-    conn = libvirt.openReadOnly("qemu+ssh://root@hpcccloud1.cmix.louisiana.edu/system")
+async def asyncCpuUsage(state):
+    loop = asyncio.get_running_loop()
+    # libvirt calls block on ssh, run them off the loop
+    conn = await loop.run_in_executor(None, openHypervisor)
+    view = ServerView(state)
     while True:
-        for server in cpu_usage.keys():
-            if server == '1': srv_name = 'WP-Host'
-            else: srv_name = f'WP-Host-0{server}'
-            domain = conn.lookupByName(srv_name)
+        for srv in view.changed(): state.setCpu(srv, 0.)
+        registry = state.registry
+
+        for srv in np.flatnonzero(registry.active):
+            domain = await loop.run_in_executor(None, conn.lookupByName, \
+                registry.names[srv])
 
             time1 = time.time()
-            clock1 = int(domain.info()[4])
-            time.sleep(1.25)
+            info1 = await loop.run_in_executor(None, domain.info)
+            await asyncio.sleep(1.25)
             time2 = time.time()
-            clock2 = int(domain.info()[4])
-            cores = int(domain.info()[3])
-
-            cpu_lock.acquire()
-            cpu_usage[server] = round((clock2 - clock1) * 100 / ((time2 - time1) * cores * 1e9), 2)
-            if cpu_usage[server] > 100: cpu_usage[server] = 100
-            cpu_lock.release()
-                                
-# Process 3
-# -----------------------------------------------------------------------------
-# Send whitelist to load balancer
-def comms(profile_matrix, workload, cpu_usage, predicted_time, whitelist, \
-    wl_lock, pt_lock, cpu_lock, model, x_scaler, y_scaler):
-    HOST = 'smartdrop'
-    PORT = 8080
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
+            info2 = await loop.run_in_executor(None, domain.info)
 
-        s.listen()
+            state.setCpu(srv, cpuPercent(time1, info1, time2, info2))
 
-        conn, addr = s.accept()
+# Send whitelist to one load balancer connection
+async def asyncComms(reader, writer, snapshot, refresh, published):
+    addr = writer.get_extra_info('peername')
+    print('Connected by: ', addr)
+    holding = False
 
-        with conn:
-            print('Connected by: ', addr)
-
-            # Main loop
-            while True:
-                # Receive 1
-                message = receiveMessage(conn)
-
-                # Set locks
-                wl_lock.acquire()
-                cpu_lock.acquire()
-                pt_lock.acquire()
-
-                # Calculate whitelist
-                whiteAlg(profile_matrix, cpu_usage, workload, predicted_time, \
-                    model, x_scaler, y_scaler, whitelist)
+    try:
+        while True:
+            # Receive 1
+            await reader.readexactly(MSGLEN)
+            start = time.perf_counter()
+
+            # A whitelist from this refresh interval is served at once, an
+            # older one asks for a fresh whitelist and falls back to the last
+            # good one
+            _, generation = snapshot.latest()
+            with stats.timer('deadline_wait'):
+                if snapshot.age() >= REFRESH_INTERVAL:
+                    refresh.set()
+                    try:
+                        async with published:
+                            await asyncio.wait_for(published.wait_for( \
+                                lambda: snapshot.generation > generation), \
+                                COMPUTE_DEADLINE)
+                    except asyncio.TimeoutError:
+                        snapshot.markStale()
+
+            # Offload latest finished whitelist (shared by every connection)
+            offload(snapshot)
+
+            # Send 1
+            writer.write(b'1')
+            holding = True
+            snapshot.holders += 1
+            await writer.drain()
+            stats.record('handshake', time.perf_counter() - start)
+
+            # Receive 2
+            await reader.readexactly(MSGLEN)
+            holding = False
+            snapshot.holders -= 1
+
+            # Send 2
+            writer.write(b'2')
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        # Other connections keep being served
+        print('Connection broken: ', addr)
+    finally:
+        if holding: snapshot.holders -= 1
+        writer.close()
+
+# Recalculate the whitelist in an executor, periodically or on request
+async def asyncWorker(features, state, whitelist, model, x_scaler, y_scaler, \
+    snapshot, refresh, published):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers = 1)
+    last_input = np.full((2, len(state.registry.servers)), np.nan)
+    cache = PredictionCache()
+    view = ServerView(state)
+    stats_time = time.time()
+    discovery_time = time.time()
 
-                # Release locks
-                pt_lock.release()
-                cpu_lock.release()
-                wl_lock.release()
+    while True:
+        try: await asyncio.wait_for(refresh.wait(), REFRESH_INTERVAL)
+        except asyncio.TimeoutError: pass
+        refresh.clear()
 
-                # ***
-                # for task in whitelist: print(f'\n{task}\n{whitelist[task]}\n')
+        if time.time() - discovery_time >= DISCOVERY_INTERVAL:
+            await loop.run_in_executor(executor, discoverServers, state)
+            discovery_time = time.time()
 
-                # Offload whitelist data
-                fileWrite(whitelist)
+        data = await loop.run_in_executor(executor, refreshWhitelist, features, \
+            state, whitelist, model, x_scaler, y_scaler, last_input, cache, view)
+        snapshot.publish(data)
+        async with published: published.notify_all()
+        stats_time = reportStats(state, snapshot, cache, stats_time)
 
-                # Send 1
-                sendMessage(conn, b'1')
+# Partitions
+# -----------------------------------------------------------------------------
+# Each partition predicts for its own server group, the merge instance joins
+# their whitelists column-wise and serves it to the load balancers.
+# Send this partition's whitelist to the merge instance after every refresh
+def partitionComms(features, state, whitelist, model, x_scaler, y_scaler, \
+    merge_addr):
+    snapshot = Snapshot()
+    snapshot.publish(serialize(whitelist, state.registry))
+    refresh = threading.Event()
+    link = PartitionLink(None, merge_addr)
+
+    worker = threading.Thread(target = whitelistWorker, args = (features, state, \
+        whitelist, model, x_scaler, y_scaler, snapshot, refresh, \
+        lambda: pushPartial(link, snapshot)), daemon = True)
+    worker.start()
+
+    signal.signal(signal.SIGUSR1, \
+        lambda signum, frame: stats.dumpLater(sys.stdout))
 
-                # Receive 2
-                message = receiveMessage(conn)
+    while True:
+        try:
+            conn = socket.create_connection(merge_addr)
+        except OSError:
+            time.sleep(REFRESH_INTERVAL)
+            continue
+        print('Connected to merge: ', merge_addr)
 
-                # Send 2
-                sendMessage(conn, b'2')
+        with conn:
+            # Name this partition before sending whitelists
+            index, count = state.registry.partition
+            conn.sendall(frame(f'{index}/{count}'))
+            with link.lock: link.conn = conn
+            pushPartial(link, snapshot)
+            try:
+                # Receive r: the merge instance wants a fresh whitelist
+                while conn.recv(MSGLEN): refresh.set()
+            except ConnectionError:
+                pass
+            with link.lock: link.conn = None
+        print('Connection broken: ', merge_addr)
+
+# Length-prefixed copy of the latest whitelist to the merge instance
+def pushPartial(link, snapshot):
+    data, _ = snapshot.latest()
+    with link.lock:
+        if link.conn is None: return
+        # A broken link is noticed and replaced by the reading loop
+        try: link.conn.sendall(frame(data))
+        except OSError: pass
+
+# Length-prefixed message between a partition and the merge instance
+def frame(text):
+    payload = text.encode()
+    return struct.pack('!I', len(payload)) + payload
+
+# Join partition whitelists and serve the result to every load balancer
+def mergeComms(merge_addr, count):
+    snapshot = Snapshot()
+    refresh = threading.Event()
+    links = []
+    clients = []
+    # Latest whitelist of each partition, kept after its link is lost
+    partials = [None] * count
+
+    signal.signal(signal.SIGUSR1, \
+        lambda signum, frame: stats.dumpLater(sys.stdout))
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as p, \
+        socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s, \
+        selectors.DefaultSelector() as selector:
+        p.bind(merge_addr)
+        p.listen()
+        p.setblocking(False)
+        selector.register(p, selectors.EVENT_READ)
+        # Load balancers connect at once, their handshakes are held until
+        # the first merged whitelist
+        s.bind((HOST, PORT))
+        s.listen()
+        s.setblocking(False)
+        selector.register(s, selectors.EVENT_READ)
+
+        # Main loop
+        while True:
+            for (key, _) in selector.select(waitTimeout(clients, snapshot)):
+                if key.fileobj is p:
+                    conn, addr = p.accept()
+                    print('Partition connected: ', addr)
+                    conn.setblocking(False)
+                    link = PartitionLink(conn, addr)
+                    selector.register(conn, selectors.EVENT_READ, link)
+                    links.append(link)
+                elif key.fileobj is s:
+                    acceptClient(s, selector, clients)
+                elif isinstance(key.data, PartitionLink):
+                    link = key.data
+                    try:
+                        receivePartials(link, partials)
+                    except (RuntimeError, ConnectionError) as error:
+                        print('Partition lost: ', link.addr, error)
+                        selector.unregister(link.conn)
+                        link.conn.close()
+                        links.remove(link)
+                    mergeRound(links, partials, snapshot)
+                else:
+                    try:
+                        handshake(key.data, snapshot, refresh)
+                    except (RuntimeError, ConnectionError):
+                        dropClient(key.data, selector, clients, snapshot)
+
+            # Relay LB refresh requests to every partition
+            if refresh.is_set():
+                refresh.clear()
+                for link in links:
+                    if link.index is None: continue
+                    try: link.conn.send(b'r')
+                    except OSError: pass
+
+            for client in serveClients(clients, snapshot):
+                dropClient(client, selector, clients, snapshot)
+
+# Read whatever arrived from a partition, keeping its latest whole whitelist.
+# Its first frame names the partition (I/N), N must match the merge instance.
+def receivePartials(link, partials):
+    chunk = link.conn.recv(65536)
+    if chunk == b'': raise RuntimeError("Socket connection broken.")
+    link.buffer += chunk
+    while len(link.buffer) >= 4:
+        (size,) = struct.unpack('!I', link.buffer[:4])
+        if len(link.buffer) < 4 + size: break
+        payload = link.buffer[4:4 + size].decode()
+        link.buffer = link.buffer[4 + size:]
+        if link.index is None:
+            try: index, count = partitionArg(payload)
+            except argparse.ArgumentTypeError: count = None
+            if count != len(partials):
+                raise RuntimeError(f"Expected a partition of {len(partials)}, "
+                    f"got {payload}.")
+            link.index = index
+            continue
+        partials[link.index] = payload
+        link.fresh = True
+
+# Publish a merged whitelist once every partition has sent a part and every
+# connected one a new part. A lost partition's last part stands in for it
+# until it reconnects, so its servers are never left out.
+def mergeRound(links, partials, snapshot):
+    if None in partials: return
+    if not any(link.fresh for link in links): return
+    if not all(link.fresh for link in links if link.index is not None): return
+    with stats.timer('merge'): data = mergeWhitelists(partials)
+    snapshot.publish(data)
+    for link in links: link.fresh = False
+
+# Union of the partitions' servers per task, '0' where no server allows it
+def mergeWhitelists(partials):
+    merged = {}
+    for partial in partials:
+        for row in partial.splitlines():
+            task, servers = row.rsplit(',', 1)
+            if servers == '0': servers = ''
+            merged[task] = merged.get(task, '') + servers
+    return ''.join(f'{task},{servers or "0"}\n' \
+        for (task, servers) in merged.items())
 
 # Whitelist Algorithm
 # -----------------------------------------------------------------------------
 # Calculate task whitelists
-def whiteAlg(profile_matrix, cpu_usage, workload, predicted_time, model, x_scaler, \
-    y_scaler, whitelist):
-    GBDT(profile_matrix, cpu_usage, workload, predicted_time, model, x_scaler, \
-        y_scaler)
-
-    # Iterate for all tasks
-    for task in predicted_time.keys():
-        # Iterate for all servers
-        for server in predicted_time[task].keys():
-            # If server can't satisfy task's deadline
-            if server in whitelist[task] and \
-                predicted_time[task][server] >= SLO:
-                # Remove it from server's whitelist if it is there
-                whitelist[task].remove(server)
-
-                # ***
-                # print(
-                #     f"\n\n* Removing server {server} from task {task}"
-                #     f"\n  (PRT: {predicted_time[task][server]})"
-                # )
-
-            elif server not in whitelist[task] and \
-                predicted_time[task][server] < SLO:
-                # Add the task to the server's whitelist
-                whitelist[task].append(server)
-
-        # ***
-        for i in range(7):
-            if str(i + 1) not in whitelist[task]:
-                print(
-                    f'Non-default whitelist detected.\n'
-                    f'{task}:\n'
-                    f'{whitelist[task]}\n'
-                )
-                break
+def whiteAlg(features, state, model, x_scaler, y_scaler, whitelist, last_input, \
+    cache = None, view = None):
+    # Servers added or removed since the last run start allowed and unpredicted
+    if view is not None:
+        slots = view.changed()
+        whitelist[:, slots] = True
+        last_input[:, slots] = np.nan
+        state.predicted[:, slots] = 0.
+    registry = state.registry
+
+    # Consistent local copies of the shared inputs
+    with stats.timer('snapshot'): workload, cpu_usage = state.snapshot()
+
+    # Only servers whose inputs moved need new predictions
+    servers = dirtyServers(workload, cpu_usage, last_input, registry.active)
+    if len(servers):
+        output_data = GBDT(features, state, workload, cpu_usage, model, \
+            x_scaler, y_scaler, servers, cache)
+
+        # Server stays whitelisted while it can satisfy the task's deadline
+        # Rows = Task type, Columns = Server
+        with stats.timer('diff'):
+            whitelist[:, servers] = output_data.T < SLO
+
+    # ***
+    for task in np.flatnonzero(~whitelist[:, registry.active].all(axis = 1)):
+        allowed = whitelist[task] & registry.active
+        print(
+            f'Non-default whitelist detected.\n'
+            f'{registry.tasks[task]}:\n'
+            f'{list(itertools.compress(registry.servers, allowed))}\n'
+        )
+
+# Ids of active servers whose workload or CPU moved beyond epsilon since last
+# prediction
+def dirtyServers(workload, cpu_usage, last_input, active):
+    # Never predicted (NaN) compares as dirty
+    dirty = ~(abs(workload - last_input[0]) <= WL_EPSILON) | \
+        ~(abs(cpu_usage - last_input[1]) <= CPU_EPSILON)
+    servers = np.flatnonzero(dirty & active)
+    last_input[0, servers] = workload[servers]
+    last_input[1, servers] = cpu_usage[servers]
+    return servers
 
 # Gradient Boosted Decision Tree
 # -----------------------------------------------------------------------------
 # Predict task types' response time on each server
-def GBDT(profile_matrix, cpu_usage, workload, predicted_time, model, x_scaler, \
-    y_scaler):
-    # N channel matrix, where N = Number of servers
-
-    for server in cpu_usage.keys():
-        # Convert task features into list format
-        method_buff = []
-        url_buff = []
-        query_buff = []
-        content_buff = []
-        size_buff = []
-        size_stdev_buff = []
-        time_buff = []
-        time_stdev_buff = []
-        for task_key in profile_matrix:
-            task = profile_matrix[task_key]
-            method_buff.append(task.method)
-            url_buff.append(task.url)
-            query_buff.append(task.query)
-            content_buff.append(task.content)
-            size_buff.append(task.avg_size)
-            size_stdev_buff.append(task.size_stdev)
-            time_buff.append(task.avg_time)
-            time_stdev_buff.append(task.time_stdev)
-
-        # Convert CPU and workload into list format
-        srv_buff = [] # Is this necessary?
-        cpu_buff = []
-        wl_buff = []
-        # Remove this line when we know for sure -->
-        for _ in profile_matrix:
-            srv_buff.append(server)
-            cpu_buff.append(cpu_usage[server])
-            wl_buff.append(workload[server])
-
-        df = pd.DataFrame(list(zip(method_buff, url_buff, query_buff, \
-            content_buff, size_buff, size_stdev_buff, time_buff, time_stdev_buff, \
-            srv_buff, wl_buff, cpu_buff)), columns = ['Method', 'URL', 'Query', \
-            'Content', 'Size', 'SizeStdev', 'Time', 'TimeStdev', 'Server', \
-            'Workload', 'CPU'])
-
-        df = df.replace('NULL', '') # Not necessary
-
-        # ***
-        # headers = []
-        # for column in df.columns:
-        #     headers.append(column)
-        # headers = ','.join(headers)
-        # with open('/test_before.csv', 'w') as file: file.write(headers)
-
-        df = pd.get_dummies(df, columns = ['Method', 'URL', 'Query', 'Content'], \
-            sparse = True)
-
-        # ***
-        # headers = []
-        # for column in df.columns:
-        #     headers.append(column)
-        # headers = ','.join(headers)
-        # with open('/test_after.csv', 'w') as file: file.write(headers)
-        # sys.exit()
-
-        df = df.drop(columns = ['Query_'])
-
-        # Use each metric as a column in matrix
-        input_data = df.to_numpy()
-
-        # Perform ML inference
-        output_data = []
-        # Each row is a task type
-        for row in input_data:
-            row = x_scaler.transform(row.reshape(1, -1)) # Single sample
-            output_data.append(abs(model.predict(row)))
-        for (task, time_on_server) in zip(predicted_time.keys(), output_data):
-            time_on_server = y_scaler.inverse_transform(time_on_server)
-            predicted_time[task][server] = time_on_server
+def GBDT(features, state, workload, cpu_usage, model, x_scaler, y_scaler, \
+    servers = None, cache = None):
+    # Ids of the servers to predict, metrics are indexed by server id
+    if servers is None: servers = np.arange(len(state.registry.servers))
+    srv_values = state.registry.srv_values[servers]
+    wl_values = workload[servers]
+    cpu_values = cpu_usage[servers]
+    task_count = len(features.tasks)
+
+    # Cached predictions are made (and looked up) at bucket values
+    if cache is not None:
+        wl_values = cache.quantize(wl_values, cache.wl_bucket)
+        cpu_values = cache.quantize(cpu_values, cache.cpu_bucket)
+
+    # Rows = Server, Columns = Task type
+    output_data = np.empty((len(servers), task_count))
+    missing = list(range(len(servers)))
+    if cache is not None:
+        with stats.timer('cache'):
+            # Keyed by HAProxy id, not slot, so reused slots never hit stale
+            # entries. One lookup covers all of a server's task types.
+            keys = list(zip(srv_values.tolist(), wl_values.tolist(), \
+                cpu_values.tolist()))
+            missing = []
+            for (server_index, key) in enumerate(keys):
+                times_on_server = cache.get(key)
+                if times_on_server is None: missing.append(server_index)
+                else: output_data[server_index] = times_on_server
+
+    # Single matrix of every task type on every uncached server
+    srv_indices = np.repeat(missing, task_count)
+    task_indices = np.tile(np.arange(task_count), len(missing))
+    if len(srv_indices):
+        with stats.timer('features'):
+            input_data = features.rows(task_indices, srv_values[srv_indices], \
+                wl_values[srv_indices], cpu_values[srv_indices])
+
+        # Perform ML inference (one call per stage for the whole matrix).
+        # sklearn's compiled tree traversal, a NumPy tree walk is slower.
+        # Rows of a fused feature block are already scaled (no x_scaler)
+        if x_scaler is not None:
+            with stats.timer('scale'): input_data = x_scaler.transform(input_data)
+        with stats.timer('predict'): prediction = abs(model.predict(input_data))
+        with stats.timer('scale'): prediction = outputTimes(prediction, y_scaler)
+        output_data[missing] = prediction.reshape(len(missing), task_count)
+
+        if cache is not None:
+            for server_index in missing:
+                cache.put(keys[server_index], output_data[server_index].copy())
+
+    # Columns of other servers are left as they were
+    state.predicted[:, servers] = output_data.T
+
+    return output_data
 
 # Utilities
 # -----------------------------------------------------------------------------
-# How many backend servers are running
+# (HAProxy id, name) of the backend's servers, None if the API is unreachable
 def detectServers():
-    SOCKET = 'TCP:haproxy:90'
-    detect = subprocess.run('echo "show servers state" | socat {} stdio'.format(SOCKET), \
-        shell = True, stdout = subprocess.PIPE).stdout.decode('utf-8')
-    return detect.count('web_servers')
-
-# Determine method, URL, etc. from task event
-def parseLine(line, profile_matrix):
-    methods = ['GET', 'POST']
-    # Query search patterns
-    q_patterns = '\?wc-ajax=add_to_cart|\?wc-ajax=get_refreshed_fragments'
-    method = None
-    query = None
-    url = None
-    content = None
-    server = None
-    error = None
-
-    # Method
     try:
-        method = line[1].replace(' ', '')
-        if method not in methods:
-            error = True
-            return method, url, query, content, server, error
+        detect = subprocess.run(f'echo "show servers state {BACKEND}" | '
+            f'socat {STATS_SOCKET} stdio', shell = True, \
+            stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, \
+            timeout = DISCOVERY_TIMEOUT).stdout.decode('utf-8')
+    except subprocess.TimeoutExpired:
+        return None
+
+    servers = []
+    for line in detect.splitlines():
+        # be_id be_name srv_id srv_name srv_addr ... (version and header skipped)
+        fields = line.split()
+        if len(fields) < 4 or fields[1] != BACKEND: continue
+        key = int(fields[2])
+        if not servable(key):
+            print(f'Ignoring {fields[3]}: HAProxy id {key} is not 1-{MAX_SERVERS}.')
+            continue
+        servers.append((key, fields[3]))
+    return servers or None
+
+# Baseline backend servers: id 1 on WP-Host, then WP-Host-02 and so on
+def defaultServers():
+    return [(key, 'WP-Host' if key == 1 else f'WP-Host-0{key}') \
+        for key in range(1, DEFAULT_SERVERS + 1)]
+
+# HAProxy ids that fit the one character the whitelist and log formats carry
+def servable(key):
+    return 1 <= key <= MAX_SERVERS
+
+# Servers of one partition (index, count), by HAProxy id
+def ownServers(servers, partition):
+    if not servers: return servers
+    index, count = partition
+    return [(key, name) for (key, name) in servers if key % count == index]
+
+# Server id of a log line, the digits before trailing delimiters
+def lineServer(line):
+    return SERVER_ID.search(line.rstrip(', |\r\n\t')).group()
+
+# Scale and mean a StandardScaler applies (identity where disabled)
+def scalerAffine(scaler):
+    count = scaler.n_features_in_
+    scale = scaler.scale_ if scaler.with_std else np.ones(count)
+    mean = scaler.mean_ if scaler.with_mean else np.zeros(count)
+    return scale, mean
+
+# Model outputs to microseconds, y_scaler.inverse_transform() without its
+# reshaping and validation
+def outputTimes(prediction, y_scaler):
+    scale, mean = scalerAffine(y_scaler)
+    return prediction * scale[0] + mean[0]
+
+# Confirm the fused feature block and output map agree with the three .sav
+# artifacts on random server states
+def checkFusion(profile_matrix, features, model, x_scaler, y_scaler, \
+    samples = 512):
+    rng = np.random.default_rng(0)
+    task_indices = rng.integers(0, len(features.tasks), samples)
+    srv_values = rng.integers(1, MAX_SERVERS + 1, samples).astype(float)
+    wl_values = rng.uniform(0, 2 * SLO, samples)
+    cpu_values = rng.uniform(0, 100, samples)
+
+    raw = FeatureBlock(profile_matrix).rows(task_indices, srv_values, \
+        wl_values, cpu_values)
+    expected = abs(model.predict(x_scaler.transform(raw)))
+    expected = y_scaler.inverse_transform(expected.reshape(-1, 1)).ravel()
+    fused = features.rows(task_indices, srv_values, wl_values, cpu_values)
+    fused = outputTimes(abs(model.predict(fused)), y_scaler)
+
+    # Only float rounding may differ (microseconds)
+    if not np.allclose(fused, expected, rtol = 1e-9, atol = 1e-6):
+        sys.exit('\nScaler-fused inputs do not match the pickled model.')
+
+# Task type and server ids of a new task event, None if either is unknown.
+# Fields are checked against the registry's sets, never the profile matrix.
+def parseLine(line, tokens, registry):
+    try:
+        method = tokens[1]
+        target = tokens[2]
+        server = SERVER_ID.search(tokens[-2]).group()
     except IndexError:
-        error = True
-        return method, url, query, content, server, error
+        return None
+    if method not in registry.methods: return None
 
     # Query
-    try:
-        found = False
-        query = re.search(q_patterns, line[2].replace(' ', ''))
-        try:
-            query = query.group()
-            line[2] = line[2].replace(query, '')
-        except AttributeError: query = 'NULL'
-        for key, value in profile_matrix.items():
-            if query in key:
-                found = True
-                break
-        if found == False:
-            error = True
-            return method, url, query, content, server, error
-    except IndexError:
-        error = True
-        return method, url, query, content, server, error
+    url, mark, query = target.partition('?')
+    query = mark + query if mark else 'NULL'
+    if query not in registry.queries: return None
 
     # URL
-    try:
-        found = False
-        url = line[2].replace(' ', '')
-        if (query != 'NULL' or url == '/wp-profiling/') \
-            and 'index.php' not in url:
-            url = url + 'index.php'
-        for key, value in profile_matrix.items():
-            if url in key:
-                found = True
-                break
-        if found == False:
-            error = True
-            return method, url, query, content, server, error
-    except IndexError:
-        error = True
-        return method, url, query, content, server, error
+    if (query != 'NULL' or url == '/wp-profiling/') and 'index.php' not in url:
+        url = url + 'index.php'
+    if url not in registry.urls: return None
 
     # Content
+    content = CONTENT.search(line)
+    if content is None: return None
+
+    # Task key is hashed once, ids are used from here on
+    task = registry.task_ids.get(f'{method},{url},{query},{content.group(1)}')
+    srv = registry.server_ids.get(server)
+    if task is None or srv is None: return None
+    return task, srv
+
+# Command line options
+def parseArgs():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-m', '--mode', help = "run as three processes, as "
+        "coroutines on one asyncio loop, or merge the whitelists of partitions", \
+        choices = ['process', 'asyncio', 'merge'], default = 'process')
+    parser.add_argument('-w', '--workers', help = "log parser processes, "
+        "sharded by task ID (process mode)", type = int, default = 1)
+    parser.add_argument('-p', '--partition', help = "track the servers whose "
+        "HAProxy id is I mod N and report to the merge instance (process mode)", \
+        metavar = 'I/N', type = partitionArg, default = (0, 1))
+    parser.add_argument('--merge', help = "merge instance address", \
+        metavar = 'HOST:PORT', type = addressArg, \
+        default = (MERGE_HOST, MERGE_PORT))
+    parser.add_argument('-n', '--partitions', help = "partitions the merge "
+        "instance waits for (merge mode)", metavar = 'N', type = int, \
+        default = None)
+    parser.add_argument('-f', '--feed', help = "receive task events as syslog "
+        "datagrams on this socket instead of tailing the access log", \
+        metavar = 'udp:HOST:PORT|unix:PATH', type = feedArg, default = None)
+
+    args = parser.parse_args()
+    if args.partition[1] > 1 and args.mode != 'process':
+        parser.error('--partition requires process mode')
+    if args.mode == 'merge' and (args.partitions is None or args.partitions < 1):
+        parser.error('merge mode requires --partitions N (N >= 1)')
+    # One socket cannot be read by several shards
+    if args.feed is not None and args.workers > 1:
+        parser.error('--feed requires a single worker')
+    return args
+
+# I/N with 0 <= I < N
+def partitionArg(value):
     try:
-        content_index = None
-        for string in line:
-            if 'file:' in string:
-                content_index = line.index(string)
-                break
-        if content_index == None:
-            error = True
-            return method, url, query, content, server, error
-        content = line[content_index].replace('file:', '').replace(' ', '')
-    except IndexError:
-        error = True
-        return method, url, query, content, server, error
-
-    # Server
-    try:
-        server = line[-2][-1].replace(' ', '').replace('\n', '')
-        try: int(server)
-        except ValueError:
-            error = True
-            return method, url, query, content, server, error
-    except IndexError:
-        error = True
-        return method, url, query, content, server, error
-    except KeyError:
-        error = True
-        return method, url, query, content, server, error
-
-    return method, url, query, content, server, error
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected I/N, got {value}')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'expected 0 <= I < N, got {value}')
+    return index, count
+
+# HOST:PORT
+def addressArg(value):
+    host, _, port = value.rpartition(':')
+    try: return host, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected HOST:PORT, got {value}')
+
+# udp:HOST:PORT (empty HOST for every interface) or unix:PATH
+def feedArg(value):
+    kind, _, address = value.partition(':')
+    if kind == 'unix' and address: return kind, address
+    if kind == 'udp':
+        host, port = addressArg(address)
+        return kind, (host or '0.0.0.0', port)
+    raise argparse.ArgumentTypeError( \
+        f'expected udp:HOST:PORT or unix:PATH, got {value}')
 
 # Construct shared variables
-def init(profile_matrix, workload, cpu_usage, predicted_time, whitelist, m):
-    # Detect number of backend servers
-    # srvCount = detectServers()
-    # if srvCount < 1:
-    #    sys.exit('\nInvalid server count. Are your servers running?')
+def init(profile_matrix, shared = True, writers = 1, partition = (0, 1)):
+    # Detect backend servers (this partition's share). Periodic discovery
+    # corrects the defaults once HAProxy answers.
+    servers = detectServers()
+    if servers is None:
+        print('No backend servers detected, assuming the default '
+            f'{DEFAULT_SERVERS} until HAProxy answers.')
+        servers = defaultServers()
+    servers = ownServers(servers, partition)
 
     with open('tasks.csv', 'r') as file:
         reader = csv.reader(file)
@@ -603,52 +2075,113 @@ def init(profile_matrix, workload, cpu_usage, predicted_time, whitelist, m):
         # Skip header
         next(reader)
 
-        # Profile Matrix and Whitelist
+        # Profile Matrix
         for method, url, query, content, avg_size, size_stdev, avg_time, \
             time_stdev in reader:
             if query == '': query = 'NULL'
             key = f'{method},{url},{query},{content}'
             profile_matrix[key] = TaskType(method, url, query, content, avg_size, \
                 size_stdev, avg_time, time_stdev)
-            whitelist[key] = []
 
-    # Workload and CPU Usage
-    for server in range(SRVCOUNT):
-        workload[f'{server + 1}'] = 0. # *** Should this be init. to 0.001?
-        cpu_usage[f'{server + 1}'] = 0.
+    # Task and server ids shared by every structure below, with free server
+    # slots for backends added later
+    registry = Registry(profile_matrix, [str(key) for (key, _) in servers], \
+        [name for (_, name) in servers], MAX_SERVERS, partition)
 
-    # Whitelist cont.
-    for task in whitelist:
-        for server in range(SRVCOUNT):
-            whitelist[task].append(f'{server + 1}')
+    # Workload, CPU Usage and Predicted Time (zero initialized)
+    state = SharedState(registry, shared = shared, writers = writers)
 
-    for task in profile_matrix:
-        predicted_time[task] = m.dict()
-        for server in workload.keys():
-            predicted_time[task][server] = 0
+    # Whitelist, every task starts allowed on every server
+    whitelist = np.ones((len(registry.tasks), len(registry.servers)), dtype = bool)
 
-# Get latest update to logfile
-def logRead(file):
-    file.seek(0, 2)
+    return state, whitelist
 
-    while True:
-        line = file.readline()
-        if not line: continue
-        yield line
+# Start a record file section, once per run
+def startRecord():
+    with open(RECORD_PATH, 'a') as record_file:
+        record_file.write(
+            'method,url,query,content,avg_size,size_stdev,avg_time,time_stdev,'
+            'server,workload,cpu_usage,predicted_time,actual_time\n'
+        )
 
-# Write data to file
-def fileWrite(whitelist):
-    t = '' # Simplify dict to list object
-    for task in whitelist:
-        t += str(task)
+# Open the record file unbuffered, each write() is one append (shards share it)
+def openRecord():
+    return open(RECORD_PATH, 'ab', buffering = 0)
+
+# Checkpoint file of one worker, partitions of the shared log keep their own
+def checkpointPath(registry, shard = 0):
+    return f'{CHECKPOINT_PATH}.{registry.partition[0]}.{shard}'
+
+# Stats file of a task event worker, by partition and shard
+def workerStatsPath(registry, shard = 0):
+    base = os.path.splitext(STATS_PATH)[0]
+    return f'{base}.{registry.partition[0]}.{shard}.json'
+
+# Read-only hypervisor connection for CPU sampling
+def openHypervisor():
+    # Only needed on the VM host, keeps smartdrop importable elsewhere
+    import libvirt
+    return libvirt.openReadOnly("qemu+ssh://root@hpcccloud1.cmix.louisiana.edu/system")
+
+# CPU utilization between two domain.info() readings
+def cpuPercent(time1, info1, time2, info2):
+    clock1 = int(info1[4])
+    clock2 = int(info2[4])
+    cores = int(info2[3])
+    cpu = round((clock2 - clock1) * 100 / ((time2 - time1) * cores * 1e9), 2)
+    if cpu > 100: cpu = 100
+    return cpu
+
+# Get latest updates to logfile (or feed) in batches of lines, [] when idle so
+# callers can do housekeeping
+def logRead(source):
+    while True:
+        lines = source.read()
+        if not lines: source.wait()
+        yield lines
+
+# Log lines of a fed datagram, without the syslog header if it has one
+def syslogLines(data):
+    lines = []
+    for line in data.decode(errors = 'replace').splitlines():
+        header = SYSLOG_HEADER.match(line)
+        if header: line = line[header.end():]
+        lines.append(line + '\n')
+    return lines
+
+# Non-blocking inotify descriptor watching a file, None where unsupported.
+# Given a descriptor (a rotated log's), the file's watch is added to it.
+def inotifyWatch(path, fd = None):
+    new = fd is None
+    try:
+        libc = ctypes.CDLL(None, use_errno = True)
+        if new: fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return fd
+    if fd < 0: return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), \
+        IN_MODIFY | IN_DELETE_SELF | IN_MOVE_SELF) < 0 and new:
+        os.close(fd)
+        return None
+    return fd
+
+# Simplify whitelist matrix to file format
+def serialize(whitelist, registry):
+    t = ''
+    for (task, allowed) in zip(registry.tasks, whitelist):
+        t += task
         t += ','
-        if not whitelist[task]:
+        servers = ''.join(itertools.compress(registry.servers, \
+            allowed & registry.active))
+        if not servers:
             t += '0\n'
         else:
-            for server in whitelist[task]:
-                    t += server
+            t += servers
             t += '\n'
+    return t
 
+# Write data to file
+def fileWrite(t):
     # Offload data to file
     with open("/Whitelist/whitelist.csv", "r+") as file:
         file.truncate(0)
@@ -682,24 +2215,22 @@ def receiveMessage(conn):
 
     return b''.join(chunks)
 
-def debugPrint(cpu_usage, cpu_lock, predicted_time, pt_lock, workload, wl_lock):
+def debugPrint(state):
     while True:
         time.sleep(5)
-        rnd_task = random.choice(list(predicted_time.keys()))
-        cpu_lock.acquire()
-        pt_lock.acquire()
-        wl_lock.acquire()
+        state.syncServers()
+        registry = state.registry
+        rnd_task = random.randrange(len(registry.tasks))
+        workload, cpu_usage = state.snapshot()
 
         print('\n\n- SYSTEM DIAGNOSTICS -')
-        for server in workload.keys():
-            print(f'{server} CPU: {cpu_usage[server]} Workload: {workload[server]}')
+        for srv in np.flatnonzero(registry.active):
+            server = registry.servers[srv]
+            print(f'{server} CPU: {cpu_usage[srv]} Workload: {workload[srv]}')
         print('\n- TASK DIAGNOSTICS -')
-        print(f'Randomly selected task: {rnd_task}')
-        for server in predicted_time[rnd_task].keys():
-            print(f'PRT for {server}: {predicted_time[rnd_task][server]}')
-
-        cpu_lock.release()
-        pt_lock.release()
-        wl_lock.release()
+        print(f'Randomly selected task: {registry.tasks[rnd_task]}')
+        for srv in np.flatnonzero(registry.active):
+            server = registry.servers[srv]
+            print(f'PRT for {server}: {state.getPredicted(rnd_task, srv)}')
 
 if __name__ == '__main__': main()
\ No newline at end of file
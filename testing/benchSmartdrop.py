@@ -0,0 +1,168 @@
+import os
+import io
+import sys
+import time
+import json
+import itertools
+import argparse
+from statistics import mean, median
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import numpy as np
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.preprocessing import StandardScaler
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)) + '/../smartdrop')
+import smartdrop as sd
+
+CURR_PATH = os.getcwd()
+METHODS = ['GET', 'POST']
+QUERIES = ['NULL', '?wc-ajax=add_to_cart', '?wc-ajax=get_refreshed_fragments']
+
+def main():
+    args = init()
+    start_time = datetime.now()
+    print(f'Starting benchmark [{start_time}]')
+
+    results = []
+    for task_count in args.tasks:
+        profile_matrix = syntheticTasks(task_count, args.seed)
+        features = sd.FeatureBlock(profile_matrix)
+        model, x_scaler, y_scaler = trainModel(features, max(args.servers), \
+            args.trees, args.depth, args.seed)
+
+        for srv_count in args.servers:
+            print(f'Tasks: {task_count} Servers: {srv_count}')
+            results += runGrid(profile_matrix, features, model, x_scaler, \
+                y_scaler, srv_count, args.repeat, args.seed)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent = 2)
+
+    end_time = datetime.now()
+    print(f'Benchmark complete [{end_time}]: {args.output}')
+
+# Time each stage for one (task count, server count) pair
+def runGrid(profile_matrix, features, model, x_scaler, y_scaler, srv_count, \
+    repeat, seed):
+    profile_tasks = features.tasks
+    workload, cpu_usage = syntheticServers(srv_count, seed)
+    servers = list(workload.keys())
+    registry = sd.Registry(profile_matrix, servers)
+    state = sd.SharedState(registry)
+    state.workload[:] = list(workload.values())
+    state.cpu[:] = list(cpu_usage.values())
+    whitelist = np.ones((len(profile_tasks), srv_count), dtype = bool)
+    input_data = features.build(servers, workload, cpu_usage)
+
+    stages = {
+        # Every server dirty, no cache: worst case refresh
+        'whitelist' : lambda: whiteAlg(features, state, model, x_scaler, \
+            y_scaler, whitelist),
+        'inference' : lambda: y_scaler.inverse_transform( \
+            abs(model.predict(x_scaler.transform(input_data))).reshape(-1, 1)),
+        'features' : lambda: features.build(servers, workload, cpu_usage),
+        'serialize' : lambda: sd.serialize(whitelist, registry)
+    }
+
+    results = []
+    for (stage, run) in stages.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        results.append({
+            'stage' : stage,
+            'tasks' : len(profile_tasks),
+            'servers' : srv_count,
+            'rows' : len(input_data),
+            'repeat' : repeat,
+            'min' : min(timings),
+            'median' : median(timings),
+            'mean' : mean(timings)
+        })
+
+    state.close()
+    state.unlink()
+    return results
+
+# Full whitelist computation with diagnostics silenced
+def whiteAlg(features, state, model, x_scaler, y_scaler, whitelist):
+    last_input = np.full((2, len(state.registry.servers)), np.nan)
+    with redirect_stdout(io.StringIO()):
+        sd.whiteAlg(features, state, model, x_scaler, y_scaler, whitelist, \
+            last_input)
+
+# Profile matrix of unique task types with a realistic one-hot width
+def syntheticTasks(task_count, seed):
+    rng = np.random.default_rng(seed)
+    pool = max(4, int(np.ceil(np.sqrt(task_count))))
+    urls = [f'/wp-profiling/index.php/synthetic/{i}/' for i in range(pool)]
+    contents = ['None'] + [f'{i}K' for i in range(1, pool)]
+
+    combos = list(itertools.product(METHODS, urls, QUERIES, contents))
+    picks = rng.choice(len(combos), size = task_count, replace = False)
+
+    profile_matrix = {}
+    for pick in picks:
+        method, url, query, content = combos[pick]
+        avg_time = rng.uniform(1.e3, 3.e5)
+        key = f'{method},{url},{query},{content}'
+        profile_matrix[key] = sd.TaskType(method, url, query, content, \
+            str(rng.uniform(300, 1.e6)), '0.0', str(avg_time), \
+            str(rng.uniform(0, avg_time / 4)))
+    return profile_matrix
+
+# Server names '1'..'N' with random workload and CPU readings
+def syntheticServers(srv_count, seed):
+    rng = np.random.default_rng(seed)
+    servers = [f'{server + 1}' for server in range(srv_count)]
+    workload = dict(zip(servers, rng.uniform(0, sd.SLO, srv_count).tolist()))
+    cpu_usage = dict(zip(servers, rng.uniform(0, 100, srv_count).tolist()))
+    return workload, cpu_usage
+
+# Small stand-in for GBDT_Scaled_Norm.sav trained on synthetic states
+def trainModel(features, srv_count, trees, depth, seed, samples = 4000):
+    rng = np.random.default_rng(seed)
+    task_indices = rng.integers(0, len(features.tasks), samples)
+    srv_values = rng.integers(1, srv_count + 1, samples).astype(float)
+    wl_values = rng.uniform(0, sd.SLO, samples)
+    cpu_values = rng.uniform(0, 100, samples)
+    input_data = features.rows(task_indices, srv_values, wl_values, cpu_values)
+
+    # Response time grows with queued work and CPU pressure
+    time_col = features.columns.index('Time')
+    output_data = input_data[:, time_col] * (1 + cpu_values / 100) \
+        + wl_values / 4 + rng.normal(0, 1.e4, samples)
+
+    x_scaler = StandardScaler().fit(input_data)
+    y_scaler = StandardScaler().fit(output_data.reshape(-1, 1))
+    model = GradientBoostingRegressor(n_estimators = trees, max_depth = depth, \
+        random_state = seed)
+    model.fit(x_scaler.transform(input_data), \
+        y_scaler.transform(output_data.reshape(-1, 1)).ravel())
+    return model, x_scaler, y_scaler
+
+def init():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-t', '--tasks', help = "task type counts", type = int, \
+        nargs = '+', default = [25, 100, 1000, 5000])
+    parser.add_argument('-s', '--servers', help = "server counts", type = int, \
+        nargs = '+', default = [7, 16, 32, 64])
+    parser.add_argument('-r', '--repeat', help = "runs per measurement", \
+        type = int, default = 20)
+    parser.add_argument('--trees', help = "stand-in model estimators", \
+        type = int, default = 100)
+    parser.add_argument('--depth', help = "stand-in model tree depth", \
+        type = int, default = 3)
+    parser.add_argument('--seed', help = "random seed", type = int, default = 0)
+    parser.add_argument('-o', '--output', help = "JSON results file", \
+        default = CURR_PATH + '/bench_results.json')
+
+    return parser.parse_args()
+
+if __name__=="__main__":
+    main()
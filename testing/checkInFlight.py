@@ -0,0 +1,27 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)) + '/../smartdrop')
+import smartdrop as sd
+
+def main():
+    checkReapTiming()
+    print('In-flight table checks passed')
+
+# An orphaned request is reaped within one tick after its TTL, whatever the
+# fraction of a tick it was admitted at
+def checkReapTiming(ttl = sd.INFLIGHT_TTL, tick = sd.WHEEL_TICK, step = 0.05):
+    for admitted in (1000., 1000.3, 1000.7, 1000.99):
+        record = sd.InFlightTable(capacity = 4, ttl = ttl, tick = tick)
+        record.expire(admitted)
+        record.add('orphan', 0, 0, 0., 0., 0., now = admitted)
+
+        now = admitted
+        while not record.expire(now): now += step
+        age = now - admitted
+        assert ttl <= age <= ttl + tick + step, \
+            f'admitted at {admitted}, reaped at age {age:.2f}s (ttl {ttl}s)'
+        assert len(record) == 0
+
+if __name__=="__main__":
+    main()